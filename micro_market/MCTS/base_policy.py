@@ -18,3 +18,8 @@ class BasePolicy(object):
     def evaluate(self, state):
         """evaluation state"""
         raise NotImplemented
+
+    def evaluate_batch(self, states):
+        """evaluation states in batch, return (ps, vs)"""
+        results = [self.evaluate(state) for state in states]
+        return [r[0] for r in results], [r[1] for r in results]
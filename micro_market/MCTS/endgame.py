@@ -0,0 +1,47 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+class EndgameSolver(object):
+    """
+        exact backward induction solver for the last levels of an episode
+
+        env is deterministic once `idx` is fixed: nav only grows by close pct change
+        in LONG position, and final reward is `nav * trading_cost_pct_change - 1.0`.
+        `switch_pct_change` is an optional extra nav factor for every position switch,
+        default 1.0 matches FastTradingEnv which does not charge switching on nav
+    """
+
+    def __init__(self, switch_pct_change=1.0):
+        # switch[position, action]: nav factor of moving from position to action
+        self._switch = np.array([
+            [1.0, switch_pct_change],
+            [switch_pct_change, 1.0],
+        ])
+
+    def solve(self, pct_changes, position, nav, trading_cost_pct_change):
+        """
+            Args:
+                pct_changes (np.array): close pct change of every remaining step
+                position (int): current trade position
+                nav (float): current nav
+            Returns:
+                np.array: final reward of taking each action now and playing optimal after
+        """
+        assert(pct_changes.shape[0] > 0)
+        # growth[t, action]
+        growth = np.ones((pct_changes.shape[0], 2))
+        growth[:, 1] = pct_changes
+        # best nav factor from level t to the end, for each position held before t
+        v = np.full(2, trading_cost_pct_change)
+        for t in range(pct_changes.shape[0] - 1, 0, -1):
+            v = np.max(growth[t] * self._switch * v, axis=1)
+        return nav * growth[0] * self._switch[position] * v - 1.0
+
+    def solve_env(self, env):
+        position, nav = env.position_nav()
+        return self.solve(
+            env.future_pct_changes(), position, nav, env.trading_cost_pct_change
+        )
@@ -0,0 +1,42 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+class EvaluationTable(object):
+    """
+        policy evaluations of every step of current episode window,
+        obs only depends on (idx, step), so all nodes of one level share one evaluation
+    """
+
+    def __init__(self):
+        self._key = None
+        self.idx = None
+        self.ps = None
+        self.vs = None
+
+    def prepare(self, policy, env):
+        """
+            evaluate obs of all steps in env's current window with one batched call
+            Returns:
+                int: evaluated states count, 0 if table of same window and policy is ready
+        """
+        idx, _ = env.state_ref()
+        key = (env.name, idx, env.days, id(policy))
+        if key == self._key:
+            return 0
+        states = [env.observations(data_step=step, idx=idx) for step in range(env.days + 1)]
+        ps, vs = policy.evaluate_batch(states)
+        self.ps = np.asarray(ps, dtype=np.float64)
+        self.vs = np.asarray(vs, dtype=np.float64).ravel()
+        self.idx = idx
+        self._key = key
+        return len(states)
+
+    def lookup(self, state):
+        """(p, v) of state reference (idx, step), None if state out of table"""
+        idx, step = state
+        if idx != self.idx:
+            return None
+        return self.ps[step], self.vs[step]
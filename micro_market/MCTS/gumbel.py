@@ -0,0 +1,94 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+class GumbelRootSearch(object):
+    """
+        Gumbel-top-k root search with sequential halving
+        refer to: Policy improvement by planning with Gumbel (Danihelka et al. 2022)
+        root actions are sampled without replacement by gumbel + logits, the simulation budget
+        is split over phases which halve the considered actions, improved policy target is
+        softmax(logits + sigma(completed Q))
+    """
+
+    def __init__(self, max_considered=16, c_visit=50.0, c_scale=1.0):
+        self.max_considered = max_considered
+        self.c_visit = c_visit
+        self.c_scale = c_scale
+
+    @staticmethod
+    def logits(store, nid):
+        return np.log(np.maximum(store.P[nid], 1e-12))
+
+    def completed_q(self, store, nid):
+        """
+            Q of visited actions, mixed value estimation of unvisited actions,
+            scaled to [0, 1] by min/max Q of the whole tree
+        """
+        n, q = store.N[nid], store.Q[nid]
+        visited = n > 0
+        prior = store.P[nid] / store.P[nid].sum()
+        v_mix = store.V[nid]
+        if visited.any():
+            weighted_q = (prior[visited] * q[visited]).sum() / prior[visited].sum()
+            v_mix = (store.V[nid] + n.sum() * weighted_q) / (1.0 + n.sum())
+        completed = np.where(visited, q, v_mix)
+        # freed nodes keep stale stats until their ids are reused
+        visited_edges = (store.N[:store.size] > 0) & store.alive[:store.size, np.newaxis]
+        tree_q = store.Q[:store.size][visited_edges]
+        low = min(tree_q.min(), completed.min()) if tree_q.shape[0] else completed.min()
+        high = max(tree_q.max(), completed.max()) if tree_q.shape[0] else completed.max()
+        if high - low < 1e-12:
+            return np.zeros_like(completed)
+        return (completed - low) / (high - low)
+
+    def sigma(self, store, nid):
+        return (self.c_visit + store.N[nid].max()) * self.c_scale * self.completed_q(store, nid)
+
+    def improved_policy(self, store, nid):
+        scores = self.logits(store, nid) + self.sigma(store, nid)
+        exp_scores = np.exp(scores - scores.max())
+        return exp_scores / exp_scores.sum()
+
+    def search(self, store, nid, budget, simulate, rng, chunk=1):
+        """
+            run `budget` simulations at root `nid`, considered actions of one phase take
+            turns in `chunk` simulations, so an interrupted search is still balanced
+            Args:
+                simulate (callable): simulate(action, count) runs `count` simulations
+                    which start with root `action`, returns False to stop search
+            Returns:
+                list: improved policy target of root
+        """
+        gumbel = rng.gumbel(size=store.action_size)
+        logits = self.logits(store, nid)
+        considered_count = min(self.max_considered, store.action_size)
+        considered = np.argsort(-(gumbel + logits))[:considered_count]
+        phases = max(1, int(np.ceil(np.log2(considered_count))))
+        used = 0
+        for phase in range(phases):
+            size = considered.shape[0]
+            if phase == phases - 1:
+                # spend all left budget in last phase
+                counts = np.full(size, (budget - used) // size, dtype=np.int64)
+                counts[:(budget - used) % size] += 1
+            else:
+                counts = np.full(size, max(1, budget // (phases * size)), dtype=np.int64)
+                # small budget may be used up in early phases
+                total = np.minimum(np.cumsum(counts), budget - used)
+                counts = total - np.concatenate([[0], total[:-1]])
+            used += counts.sum()
+            done = np.zeros(size, dtype=np.int64)
+            while (done < counts).any():
+                for i, action in enumerate(considered.tolist()):
+                    count = min(chunk, counts[i] - done[i])
+                    if count <= 0:
+                        continue
+                    if simulate(action, int(count)) is False:
+                        return self.improved_policy(store, nid).tolist()
+                    done[i] += count
+            scores = (gumbel + logits + self.sigma(store, nid))[considered]
+            considered = considered[np.argsort(-scores)[:max(1, considered.shape[0] // 2)]]
+        return self.improved_policy(store, nid).tolist()
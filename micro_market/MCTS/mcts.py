@@ -1,63 +1,247 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
-import gc
+import time
+import itertools
+import numpy as np
 
-from utils import klass_factory
 from trading_node import TradingNode
+from search_context import SearchContext
+from gumbel import GumbelRootSearch
 
 
 class MCTSBuilder(object):
-    def __init__(self, gym_env, init_node=None, debug=False):
-        assert(gym_env)
+    ROOT_SEARCH_OPTIONS = ('puct', 'gumbel')
+
+    def __init__(
+        self, gym_env, init_node=None, context=None, debug=False, root_search='puct',
+        **context_kwargs
+    ):
+        """
+            Args:
+                init_node (TradingNode): start from exist tree, its search context is reused
+                context (SearchContext): search context of new tree, e.g. kept from a released
+                    tree, so its evaluation table is reused
+                root_search (string): 'puct' selects root actions by PUCT with dirichlet noise,
+                    'gumbel' by gumbel-top-k with sequential halving, see GumbelRootSearch
+                context_kwargs: search config of new tree, see SearchContext
+        """
+        assert(gym_env and root_search in self.ROOT_SEARCH_OPTIONS)
         self._debug = debug
         self._gym_env = gym_env
         self._root_node = init_node
+        self._env_checkpoint = None
+        self._deadline = None
+        self._completed_simulations = 0
+        self._gumbel = None
+        if root_search == 'gumbel':
+            self._gumbel = GumbelRootSearch()
+            # gumbel noise replaces dirichlet noise for exploration
+            context_kwargs.setdefault('episolon', 0.0)
+        if init_node:
+            self._context = init_node._context
+        elif context:
+            self._context = context
+        else:
+            self._context = SearchContext(env=gym_env, **context_kwargs)
 
     @property
-    def node_klass(self):
-        copy_env = self._gym_env
-        klass_init_args = {
-            'env': copy_env,
-        }
-        return klass_factory(
-            'Env_{name}_TradingNode'.format(name=copy_env.name),
-            init_args=klass_init_args,
-            base_klass=TradingNode
-        )
+    def context(self):
+        return self._context
+
+    @property
+    def stats(self):
+        """SearchStats of the tree, accumulated over runs until `stats.reset()`"""
+        return self._context.stats
+
+    @property
+    def completed_simulations(self):
+        """simulations completed by last `run_batch`"""
+        return self._completed_simulations
+
+    def stats_summary(self):
+        store = self._root_node._store if self._root_node else None
+        return self._context.stats.summary(store=store)
 
     def clean_up(self):
-        # clean up
+        # clean up, tree store holds no reference cycles so no gc needed
         self._root_node = None
-        gc.collect()
 
-    def run_once(self, policy, env_snapshot=None):
-        if not self._root_node:
-            # init node
-            self._root_node = self.node_klass(state=None)
+    def _episode_start(self, env_snapshot=None):
         # episode start
-        if env_snapshot:
+        if self._env_checkpoint:
+            # rewind env to search start point
+            self._gym_env.rewind(self._env_checkpoint)
+        elif env_snapshot:
             # recover gym env from env_snapshot if exist
             self._gym_env.recover(env_snapshot)
         else:
             # simply reset env
             self._gym_env.reset()
-        # recover node's env
-        self._root_node.set_env(self._gym_env)
-        current_node = self._root_node
+        # recover tree's env
+        self._context.env = self._gym_env
+        if not self._root_node:
+            # init node
+            self._root_node = TradingNode(context=self._context)
+
+    def run_once(self, policy, env_snapshot=None, root_action=None):
+        self._episode_start(env_snapshot)
+        current_node = self._root_node.step(policy, action=root_action)
         while current_node:
             current_node = current_node.step(policy)
         # episode end
+        self._context.stats.simulations += 1
         return self._root_node
 
-    def run_batch(self, policy, batch_size=100, env_snapshot=None):
-        idx_list = range(batch_size)
+    def run_leaf_batch(
+        self, policy, leaf_batch_size, env_snapshot=None, virtual_loss=1.0, root_action=None
+    ):
+        """
+            descend `leaf_batch_size` simulations with virtual loss,
+            evaluate all new leaves in one policy call, then backup
+        """
+        leaves = []
+        for _ in range(leaf_batch_size):
+            self._episode_start(env_snapshot)
+            leaves.append(
+                self._root_node.select_leaf(virtual_loss=virtual_loss, action=root_action)
+            )
+        stats = self._context.stats
+        table = self._context.eval_table
+        leaf_states = [(obs, state) for _, _, obs, state, _, _ in leaves if obs is not None]
+        evaluations = [table.lookup(state) if table else None for _, state in leaf_states]
+        # leaves missing in evaluation table are evaluated in one policy call
+        missing = [i for i, evaluation in enumerate(evaluations) if evaluation is None]
+        if missing:
+            start_time = time.time()
+            batch_ps, batch_vs = policy.evaluate_batch([leaf_states[i][0] for i in missing])
+            stats.add_evaluation(time.time() - start_time, count=len(missing))
+            for i, p, v in zip(missing, batch_ps, batch_vs):
+                evaluations[i] = (p, v)
+        ps = [p for p, _ in evaluations]
+        vs = [v for _, v in evaluations]
+        self._root_node.expand_leaves(leaves, ps, vs)
+        stats.simulations += leaf_batch_size
+        return self._root_node
+
+    def _out_of_time(self):
+        return self._deadline is not None and time.time() >= self._deadline
+
+    def _root_visits_per_simulation(self, leaf_batch_size):
+        """max visits one simulation adds to a root edge"""
+        if leaf_batch_size > 1:
+            # leaf batch simulations backup once at the leaf
+            return 1
+        # run_once backups at every expansion, so once per level below root
+        store, nid = self._root_node._store, self._root_node._nid
+        levels = self._gym_env.days - int(store.state_step[nid])
+        if self._context.horizon:
+            levels = min(levels, self._context.horizon)
+        return max(levels, 1)
+
+    def _root_decided(self, remaining, visits_per_simulation=1):
+        # the most visited root edge can not be overtaken within `remaining` simulations
+        root_n = np.sort(self._root_node._store.N[self._root_node._nid])
+        return root_n[-1] - root_n[-2] > remaining * visits_per_simulation
+
+    def _run_gumbel(self, policy, batch_size, env_snapshot=None, leaf_batch_size=1):
+        self._episode_start(env_snapshot)
+        root_node = self._root_node
+        store, nid = root_node._store, root_node._nid
+        if not store.N[nid].any():
+            # new root is created without policy prior
+            root_node.evaluate_prior(policy)
+
+        def simulate(action, count):
+            if store.N[nid].any() and self._out_of_time():
+                return False
+            if leaf_batch_size > 1:
+                self.run_leaf_batch(
+                    policy=policy, leaf_batch_size=count, env_snapshot=env_snapshot,
+                    root_action=action,
+                )
+            else:
+                self.run_once(policy=policy, env_snapshot=env_snapshot, root_action=action)
+
+        self._context.root_targets[nid] = self._gumbel.search(
+            store, nid, batch_size, simulate, self._context.rng, chunk=max(leaf_batch_size, 1)
+        )
+
+    def _run_puct(self, policy, batch_size, env_snapshot=None, leaf_batch_size=1, early_stop=False):
+        step = max(leaf_batch_size, 1)
+        if batch_size is None:
+            # no simulation limit, run until deadline
+            idx_list = itertools.count(0, step)
+        else:
+            idx_list = range(0, batch_size, step)
         if self._debug:
             from tqdm import tqdm
             idx_list = tqdm(idx_list)
         for idx in idx_list:
-            self.run_once(
-                policy=policy,
-                env_snapshot=env_snapshot
-            )
+            if idx and self._out_of_time():
+                # at least one simulation, so root stats exist
+                break
+            if leaf_batch_size > 1:
+                self.run_leaf_batch(
+                    policy=policy,
+                    leaf_batch_size=leaf_batch_size if batch_size is None else min(
+                        leaf_batch_size, batch_size - idx),
+                    env_snapshot=env_snapshot
+                )
+            else:
+                self.run_once(
+                    policy=policy,
+                    env_snapshot=env_snapshot
+                )
+            if batch_size is None:
+                continue
+            remaining = max(batch_size - idx - step, 0)
+            if early_stop and remaining and self._root_decided(
+                    remaining, self._root_visits_per_simulation(leaf_batch_size)):
+                self._context.stats.early_stops += 1
+                self._context.stats.saved_simulations += remaining
+                break
+
+    def run_batch(
+        self, policy, batch_size=100, env_snapshot=None, leaf_batch_size=1, early_stop=False,
+        time_budget_ms=None,
+    ):
+        """
+            Args:
+                batch_size (int): max simulations, None for no limit when `time_budget_ms` is set
+                    (gumbel root search always needs it to plan phases)
+                leaf_batch_size (int): simulations evaluated together in one policy call,
+                    1 means simulate one by one until episode done
+                early_stop (bool): stop once the best root action by visit count is fixed,
+                    skipped simulations are counted in `stats.saved_simulations`,
+                    not used by gumbel root search
+                time_budget_ms (float): stop between simulations once the budget is used up,
+                    see `completed_simulations` for simulations done in time
+        """
+        assert(batch_size or (time_budget_ms and not self._gumbel))
+        if env_snapshot:
+            # recover once, then every simulation rewinds to this checkpoint
+            self._gym_env.recover(env_snapshot)
+            self._env_checkpoint = self._gym_env.checkpoint()
+        start_time = time.time()
+        if time_budget_ms:
+            self._deadline = start_time + time_budget_ms / 1000.0
+        simulations = self._context.stats.simulations
+        if self._context.eval_table is not None and not self._context.in_endgame(self._gym_env):
+            # one batched evaluation for all levels of current episode window,
+            # not needed when the root is solved by endgame solver
+            evaluated = self._context.eval_table.prepare(policy, self._gym_env)
+            if evaluated:
+                self._context.stats.add_evaluation(time.time() - start_time, count=evaluated)
+        self._context.root_targets.clear()
+        try:
+            if self._gumbel:
+                self._run_gumbel(policy, batch_size, env_snapshot, leaf_batch_size)
+            else:
+                self._run_puct(policy, batch_size, env_snapshot, leaf_batch_size, early_stop)
+        finally:
+            self._env_checkpoint = None
+            self._deadline = None
+            self._context.stats.search_time += time.time() - start_time
+            self._completed_simulations = self._context.stats.simulations - simulations
         return self._root_node
@@ -0,0 +1,103 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import random
+import logging
+import numpy as np
+from concurrent import futures
+
+from common import settings
+from mcts import MCTSBuilder
+from trading_node import TradingNode
+from search_context import SearchContext
+
+logger = logging.getLogger(__name__)
+
+# search id -> (env, policy, builder kwargs), inherited by forked worker processes
+_worker_contexts = dict()
+
+
+def _ping_func(_):
+    return True
+
+
+def _root_search_func(params):
+    gym_env, policy, builder_kwargs = _worker_contexts[params['search_id']]
+    # independent RNG stream for each worker
+    np.random.seed(params['seed'])
+    random.seed(params['seed'])
+    block = MCTSBuilder(gym_env, seed=params['seed'], **builder_kwargs)
+    root_node = block.run_batch(
+        policy=policy,
+        batch_size=params['batch_size'],
+        env_snapshot=params['env_snapshot'],
+        leaf_batch_size=params['leaf_batch_size'],
+    )
+    # only root edge stats are sent back, never the whole tree
+    store, nid = root_node._store, root_node._nid
+    return store.N[nid].copy(), store.W[nid].copy(), store.P[nid].copy()
+
+
+class RootParallelSearch(object):
+    """
+        root parallel MCTS: every worker process runs an independent tree from the same
+        env snapshot with its own RNG stream, root edge stats are merged into one root node
+
+        worker processes are forked once at init and inherit `gym_env` and `policy`,
+        so the policy model should be safe to use after fork.
+        `seed` seeds RNG streams of workers, other `builder_kwargs` are passed to MCTSBuilder
+    """
+
+    def __init__(self, gym_env, policy, workers=None, seed=None, **builder_kwargs):
+        assert(gym_env and policy)
+        self._gym_env = gym_env
+        self._workers = workers or settings.CPU_CORES
+        self._random_state = np.random.RandomState(seed)
+        self._search_id = id(self)
+        _worker_contexts[self._search_id] = (gym_env, policy, builder_kwargs)
+        self._executor = futures.ProcessPoolExecutor(max_workers=self._workers)
+        # fork all workers now, while context is registered
+        list(self._executor.map(_ping_func, range(self._workers)))
+        logger.debug('started root parallel search with {n} workers'.format(n=self._workers))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        _worker_contexts.pop(self._search_id, None)
+
+    def run_batch(self, batch_size=100, env_snapshot=None, leaf_batch_size=1):
+        """
+            split `batch_size` simulations over all workers, workers left without
+            simulations are not run
+            Returns:
+                TradingNode: root node which only holds merged root edge stats
+        """
+        if env_snapshot is None:
+            env_snapshot = self._gym_env.snapshot()
+        # first `batch_size % workers` workers run one more simulation
+        worker_batch_sizes = [
+            batch_size // self._workers + (i < batch_size % self._workers)
+            for i in range(self._workers)
+        ]
+        base_seed = self._random_state.randint(2**31 - self._workers)
+        _tasks = [self._executor.submit(_root_search_func, {
+            'search_id': self._search_id,
+            'seed': base_seed + i,
+            'batch_size': worker_batch_size,
+            'env_snapshot': env_snapshot,
+            'leaf_batch_size': leaf_batch_size,
+        }) for i, worker_batch_size in enumerate(worker_batch_sizes) if worker_batch_size]
+        results = [f.result() for f in _tasks]
+        # merge root stats
+        root_node = TradingNode(context=SearchContext(env=self._gym_env))
+        store, nid = root_node._store, root_node._nid
+        store.N[nid] = sum([n for n, _, _ in results])
+        store.W[nid] = sum([w for _, w, _ in results])
+        store.Q[nid] = store.W[nid] / np.maximum(store.N[nid], 1)
+        store.P[nid] = np.mean([p for _, _, p in results], axis=0)
+        return root_node
@@ -0,0 +1,59 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import numpy as np
+
+from endgame import EndgameSolver
+from eval_table import EvaluationTable
+from search_stats import SearchStats
+
+
+class SearchContext(object):
+    """
+        per-tree search context shared by all nodes of one tree:
+        env, counters, search config and RNG
+    """
+
+    def __init__(
+        self, env, transposition=False, max_nodes=None, endgame_levels=0,
+        c_puct=0.1, episolon=0.25, seed=None, precompute_evals=False, horizon=None,
+        nav_decimals=4,
+    ):
+        """
+            Args:
+                transposition (bool): merge nodes with same env state key, build DAG instead of tree
+                max_nodes (int): node budget of tree, least visited leaves are evicted
+                    when budget reached
+                endgame_levels (int): solve last levels of episode exactly with EndgameSolver
+                c_puct (float): exploration constant of PUCT select
+                episolon (float): weight of dirichlet noise in prior probability
+                seed (int): seed of RNG for noise and random tie break
+                precompute_evals (bool): evaluate obs of all steps once per episode window
+                    and serve expansions from EvaluationTable, policy should be deterministic
+                horizon (int): max depth of one simulation, simulations stop at `horizon` levels
+                    below search root and bootstrap from value V of the reached node,
+                    None to simulate until episode done
+                nav_decimals (int): nav of state key is rounded to it in transposition mode,
+                    merged states differ in nav by less than trading cost
+        """
+        self.env = env
+        self.episode_count = 0
+        self.transposition = transposition
+        self.nav_decimals = nav_decimals
+        self.max_nodes = max_nodes
+        self.endgame_levels = endgame_levels
+        self.endgame_solver = EndgameSolver() if endgame_levels else None
+        self.horizon = horizon
+        self.c_puct = c_puct
+        self.episolon = episolon
+        self.rng = np.random.RandomState(seed)
+        self.stats = SearchStats()
+        self.eval_table = EvaluationTable() if precompute_evals else None
+        self.root_targets = dict()  # root node id -> improved policy target of last search
+
+    def in_endgame(self, env):
+        """env is in the last `endgame_levels` levels of its episode, solved without expansion"""
+        if not self.endgame_levels:
+            return False
+        _, step = env.state_ref()
+        return env.days - step <= self.endgame_levels
@@ -0,0 +1,73 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+class SearchStats(object):
+    """low overhead counters of MCTS search"""
+
+    LATENCY_BUFFER_SIZE = 4096  # keep latest policy evaluation latencies
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.simulations = 0
+        self.expansions = 0
+        self.reuses = 0
+        self.transposition_hits = 0
+        self.endgame_solves = 0
+        self.bootstraps = 0  # simulations stopped at search horizon
+        self.early_stops = 0
+        self.saved_simulations = 0  # skipped by early stop
+        self.evaluations = 0  # evaluated states
+        self.search_time = 0.0
+        self.env_step_time = 0.0
+        self.eval_time = 0.0
+        self.depth_hist = np.zeros(32, dtype=np.int64)
+        self._latencies = np.zeros(self.LATENCY_BUFFER_SIZE)
+        self._latency_count = 0
+
+    def add_depth(self, depth):
+        if depth >= self.depth_hist.shape[0]:
+            self.depth_hist = np.concatenate(
+                [self.depth_hist, np.zeros(depth + 1, dtype=np.int64)]
+            )
+        self.depth_hist[depth] += 1
+
+    def add_evaluation(self, latency, count=1):
+        self.evaluations += count
+        self.eval_time += latency
+        self._latencies[self._latency_count % self.LATENCY_BUFFER_SIZE] = latency
+        self._latency_count += 1
+
+    def latency_percentiles(self, qs=(50, 90, 99)):
+        """policy evaluation latency percentiles in ms"""
+        latencies = self._latencies[:min(self._latency_count, self.LATENCY_BUFFER_SIZE)]
+        if not latencies.shape[0]:
+            return dict([(q, 0.0) for q in qs])
+        return dict(zip(qs, (np.percentile(latencies, qs) * 1000.0).tolist()))
+
+    def summary(self, store=None):
+        search_time = self.search_time or float('nan')
+        result = {
+            'simulations': self.simulations,
+            'simulations_per_sec': self.simulations / search_time,
+            'expansions': self.expansions,
+            'reuses': self.reuses,
+            'transposition_hits': self.transposition_hits,
+            'endgame_solves': self.endgame_solves,
+            'bootstraps': self.bootstraps,
+            'early_stops': self.early_stops,
+            'saved_simulations': self.saved_simulations,
+            'evaluations': self.evaluations,
+            'eval_latency_ms': self.latency_percentiles(),
+            'env_step_share': self.env_step_time / search_time,
+            'eval_share': self.eval_time / search_time,
+            'depth_hist': np.trim_zeros(self.depth_hist, 'b').tolist(),
+        }
+        if store is not None:
+            result['tree_nodes'] = store.node_count
+            result['tree_bytes'] = store.nbytes
+        return result
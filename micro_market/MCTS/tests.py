@@ -1,16 +1,46 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import time
 import unittest
 import cProfile
-from ete3 import Tree
+import numpy as np
 
 from common.utils import Profiling
 from envs.fast_trading_env import FastTradingEnv
-from utils import klass_factory, fast_moving
+from utils import fast_moving
+from base_policy import BasePolicy
 from trading_policy import RandomTradingPolicy, HoldTradingPolicy
 from trading_node import TradingNode
+from tree_store import TreeStore
+from search_context import SearchContext
+from endgame import EndgameSolver
 from mcts import MCTSBuilder
+from gumbel import GumbelRootSearch
+from root_parallel import RootParallelSearch
+from tree_io import save_tree, load_tree, read_header
+
+
+class CountingPolicy(BasePolicy):
+    """deterministic policy which counts evaluate calls"""
+
+    def __init__(self):
+        self.calls = 0
+        self.batch_calls = 0
+
+    def get_action(self, state):
+        return 0
+
+    def evaluate(self, state):
+        self.calls += 1
+        p = 1.0 / (1.0 + np.exp(-state[:, 3].sum()))
+        return [p, 1.0 - p], float(state[:, 3].mean())
+
+    def evaluate_batch(self, states):
+        self.batch_calls += 1
+        results = [self.evaluate(state) for state in states]
+        self.calls -= len(states)
+        return [p for p, _ in results], [v for _, v in results]
 
 
 class RandomTradingPolicyTestCase(unittest.TestCase):
@@ -26,6 +56,82 @@ class RandomTradingPolicyTestCase(unittest.TestCase):
         self.assertTrue(action in action_options)
 
 
+class TreeStoreTestCase(unittest.TestCase):
+    def test_grow_and_backup(self):
+        store = TreeStore(action_size=2, capacity=2, episolon=0.0)
+        root = store.add_node()
+        nid = root
+        for level in range(1, 10):
+            nid = store.add_node(prior_ps=[0.3, 0.7], level=level, parent=nid, action=1)
+        self.assertEqual(store.size, 10)
+        self.assertGreaterEqual(store.capacity, 10)
+        self.assertEqual(store.level[nid], 9)
+        self.assertAlmostEqual(store.P[nid, 1], 0.7)
+        # backup along the whole path
+        for depth in range(9):
+            store.record(depth, depth, 1)
+        store.backup_path(9, 0.5)
+        store.backup_path(9, 1.0)
+        self.assertTrue((store.N[:9, 1] == 2).all())
+        self.assertTrue(np.allclose(store.Q[:9, 1], 0.75))
+        self.assertEqual(store.q_table(root), [0.0, 1.0])
+        self.assertEqual(store.puct_select(root), 1)
+
+    def test_completed_q_skips_released(self):
+        store = TreeStore(action_size=2, episolon=0.0)
+        root = store.add_node()
+        child = store.add_node(level=1, parent=root, action=1)
+        store.backup([root], [0], 0.1)
+        store.backup([root], [1], 0.2)
+        store.backup([child], [0], 5.0)
+        # released sub tree keeps its stats, but does not scale Q of root
+        store.unlink(root, 1)
+        completed_q = GumbelRootSearch().completed_q(store, root)
+        self.assertTrue(np.allclose(completed_q, [0.0, 1.0]))
+
+
+class EndgameSolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.days = 20
+        self.env = FastTradingEnv(name='000333.SZ', days=self.days)
+
+    def brute_force(self, snapshot, levels):
+        # try every action sequence of the last `levels` levels on env
+        best = np.full(2, -np.inf)
+        for seq in range(2**levels):
+            self.env.recover(snapshot)
+            actions = [(seq >> i) & 1 for i in range(levels)]
+            for action in actions:
+                _, reward, done, _ = self.env.step(action)
+            self.assertTrue(done)
+            best[actions[0]] = max(best[actions[0]], reward)
+        return best
+
+    def test_solve_last_levels(self):
+        solver = EndgameSolver()
+        levels = 6
+        for _ in range(5):
+            self.env.reset()
+            fast_moving(self.env, RandomTradingPolicy(self.env.action_options()), self.days - levels)
+            snapshot = self.env.snapshot()
+            values = solver.solve_env(self.env)
+            self.assertTrue(np.allclose(values, self.brute_force(snapshot, levels)))
+
+    def test_mcts_with_endgame(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        fast_moving(self.env, policy, self.days - 3)
+        snapshot = self.env.snapshot()
+        best_action = int(np.argmax(EndgameSolver().solve_env(self.env)))
+        for leaf_batch_size in (1, 4):
+            block = MCTSBuilder(self.env, endgame_levels=5)
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot, batch_size=8, leaf_batch_size=leaf_batch_size
+            )
+            # root itself is solved, all visits go to the best action
+            self.assertEqual(root_node.q_table[best_action], 1.0)
+
+
 class TradingNodeTestCase(unittest.TestCase):
     def setUp(self):
         self.stock_name = '000333.SZ'
@@ -33,14 +139,7 @@ class TradingNodeTestCase(unittest.TestCase):
         self.env = FastTradingEnv(name=self.stock_name, days=self.days)
         action_options = self.env.action_options()
         self.policy = RandomTradingPolicy(action_options=action_options)
-        self.TradingEnvNode = klass_factory(
-            'Env_{name}_TradingNode'.format(name=self.stock_name),
-            init_args={
-                'env': self.env,
-                'graph': Tree(),
-            },
-            base_klass=TradingNode
-        )
+        self.context = SearchContext(env=self.env)
 
     def run_one_episode(self, root_node, debug=False):
         self.assertTrue(self.env and self.policy and root_node)
@@ -54,8 +153,7 @@ class TradingNodeTestCase(unittest.TestCase):
 
     def test_basic(self):
         self.assertTrue(self.env.name)
-        self.assertTrue(self.TradingEnvNode)
-        start_node = self.TradingEnvNode(state=None)
+        start_node = TradingNode(context=self.context)
         root_node = self.run_one_episode(start_node, debug=True)
         self.assertTrue(root_node)
         self.assertTrue(start_node)
@@ -64,9 +162,8 @@ class TradingNodeTestCase(unittest.TestCase):
         root_node.show_graph(name='basic')
 
     def test_multiple_episode(self):
-        self.assertTrue(self.TradingEnvNode)
         count = 100
-        root_node = self.TradingEnvNode(state=None)
+        root_node = TradingNode(context=self.context)
         for i in range(count):
             root_node = self.run_one_episode(root_node)
         self.assertTrue(root_node)
@@ -74,6 +171,32 @@ class TradingNodeTestCase(unittest.TestCase):
         # TODO: test edges
         root_node.show_graph(name='multi_episode')
 
+    def test_node_state(self):
+        # nodes only keep state reference, obs is rebuilt from env
+        self.env.reset()
+        current_node = TradingNode(context=self.context)
+        np.testing.assert_array_equal(current_node._state, self.env.observations())
+        while True:
+            current_node = current_node.step(self.policy)
+            if not current_node:
+                break
+            step = self.env.snapshot()['step']
+            np.testing.assert_array_equal(current_node._state, self.env.observations(step))
+
+    def test_interleave_trees(self):
+        # trees on different stocks share one process and one policy
+        envs = [self.env, FastTradingEnv(name='600016.SS', days=self.days)]
+        root_nodes = [TradingNode(context=SearchContext(env=env)) for env in envs]
+        for i in range(10):
+            for env, root_node in zip(envs, root_nodes):
+                env.reset()
+                current_node = root_node
+                while current_node:
+                    current_node = current_node.step(self.policy)
+        for env, root_node in zip(envs, root_nodes):
+            self.assertEqual(root_node.get_episode_count(), 10)
+            self.assertTrue(root_node._context.env is env)
+
 
 class MCTSBuilderTestCase(unittest.TestCase):
     def setUp(self):
@@ -96,6 +219,304 @@ class MCTSBuilderTestCase(unittest.TestCase):
             self.assertGreaterEqual(t_reward, 0.0)
         print root_node.q_table
 
+    def test_mcts_leaf_batch(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        block = MCTSBuilder(self.env, debug=False)
+
+        snapshot_v0 = self.env.snapshot()
+        block.clean_up()
+        root_node = block.run_batch(
+            policy, env_snapshot=snapshot_v0, batch_size=23, leaf_batch_size=8
+        )
+        self.assertTrue(root_node)
+        store = root_node._store
+        # every simulation stops at a leaf, one visit each at root
+        self.assertEqual(store.N[root_node._nid].sum(), 23)
+        # simulations of one batch may share the same new leaf
+        self.assertLessEqual(store.size, 24)
+        self.assertFalse(store.VL.any())
+        self.assertAlmostEqual(sum(root_node.q_table), 1.0)
+
+    def test_mcts_stats(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        for leaf_batch_size in (1, 8):
+            block = MCTSBuilder(self.env, debug=False)
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot_v0, batch_size=20, leaf_batch_size=leaf_batch_size
+            )
+            summary = block.stats_summary()
+            self.assertEqual(summary['simulations'], 20)
+            # every new node except root is one expansion
+            self.assertEqual(summary['expansions'], root_node._store.node_count - 1)
+            self.assertEqual(sum(summary['depth_hist']), 20)
+            self.assertGreater(summary['simulations_per_sec'], 0)
+            self.assertGreaterEqual(summary['eval_latency_ms'][99], summary['eval_latency_ms'][50])
+            self.assertGreater(summary['tree_bytes'], 0)
+            block.stats.reset()
+            self.assertEqual(block.stats_summary()['simulations'], 0)
+
+    def test_mcts_early_stop(self):
+        # root in endgame levels, every simulation visits the best action once,
+        # so early stop fires for both simulation modes
+        env = FastTradingEnv(name=self.stock_name, days=5)
+        policy = RandomTradingPolicy(action_options=env.action_options())
+        env.reset()
+        fast_moving(env, policy, 2)
+        snapshot = env.snapshot()
+        best_action = int(np.argmax(EndgameSolver().solve_env(env)))
+        for leaf_batch_size in (1, 8):
+            block = MCTSBuilder(env, debug=False, seed=1, endgame_levels=3)
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot, batch_size=200,
+                leaf_batch_size=leaf_batch_size, early_stop=True,
+            )
+            stats = block.stats
+            self.assertGreater(stats.early_stops, 0)
+            self.assertGreater(stats.saved_simulations, 0)
+            self.assertEqual(stats.simulations + stats.saved_simulations, 200)
+            self.assertEqual(int(np.argmax(root_node._store.N[root_node._nid])), best_action)
+            # run skipped simulations, best action does not change
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot, batch_size=stats.saved_simulations,
+                leaf_batch_size=leaf_batch_size,
+            )
+            self.assertEqual(int(np.argmax(root_node._store.N[root_node._nid])), best_action)
+
+    def test_mcts_precompute_evals(self):
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        results = []
+        for precompute_evals in (False, True):
+            for leaf_batch_size in (1, 8):
+                policy = CountingPolicy()
+                block = MCTSBuilder(self.env, seed=1, precompute_evals=precompute_evals)
+                root_node = block.run_batch(
+                    policy, env_snapshot=snapshot_v0, batch_size=40,
+                    leaf_batch_size=leaf_batch_size,
+                )
+                if precompute_evals:
+                    # all expansions served by evaluation table of one batched call
+                    self.assertEqual((policy.calls, policy.batch_calls), (0, 1))
+                    self.assertEqual(block.stats.evaluations, self.days + 1)
+                else:
+                    self.assertGreater(policy.calls + policy.batch_calls, 1)
+                results.append(root_node._store.N[root_node._nid].tolist())
+        # same search result with or without evaluation table
+        self.assertEqual(results[:2], results[2:])
+
+    def test_mcts_precompute_evals_in_endgame(self):
+        self.env.reset()
+        fast_moving(self.env, RandomTradingPolicy(self.env.action_options()), self.days - 3)
+        snapshot = self.env.snapshot()
+        policy = CountingPolicy()
+        block = MCTSBuilder(self.env, precompute_evals=True, endgame_levels=5)
+        block.run_batch(policy, env_snapshot=snapshot, batch_size=8)
+        # root is solved by endgame solver, no evaluation is needed
+        self.assertEqual((policy.calls, policy.batch_calls), (0, 0))
+
+    def test_gumbel_benchmark(self):
+        # target quality against simulation count at production episode length and budget,
+        # exact root action values as ground truth
+        days = 30
+        env = FastTradingEnv(name=self.stock_name, days=days)
+        policy = HoldTradingPolicy(action_options=env.action_options())
+        policy.evaluate = lambda state: ([0.5, 0.5], 0.0)  # uninformative policy
+        solver = EndgameSolver()
+        np.random.seed(0)
+        snapshots = []
+        for _ in range(20):
+            env.reset()
+            snapshots.append(env.snapshot())
+        curve = dict()
+        for batch_size in (4, 8, 23):
+            for root_search in MCTSBuilder.ROOT_SEARCH_OPTIONS:
+                masses, regrets = [], []
+                for i, snapshot in enumerate(snapshots):
+                    env.recover(snapshot)
+                    values = np.array(solver.solve_env(env))
+                    block = MCTSBuilder(env, root_search=root_search, endgame_levels=0, seed=i)
+                    root_node = block.run_batch(
+                        policy, env_snapshot=snapshot, batch_size=batch_size
+                    )
+                    target = np.array(root_node.q_table)
+                    self.assertAlmostEqual(target.sum(), 1.0)
+                    # probability of best action and value lost by greedy action of target
+                    masses.append(target[values.argmax()])
+                    regrets.append(values.max() - values[target.argmax()])
+                curve[(root_search, batch_size)] = (np.mean(masses), np.mean(regrets))
+        for root_search in MCTSBuilder.ROOT_SEARCH_OPTIONS:
+            print '{s}: (simulations, best action prob, regret): {c}'.format(
+                s=root_search, c=[
+                    (n, ) + curve[(s, n)] for s, n in sorted(curve.keys()) if s == root_search
+                ]
+            )
+
+    def test_mcts_time_budget(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        for root_search, batch_size in (('puct', None), ('puct', 10**6), ('gumbel', 10**6)):
+            for leaf_batch_size in (1, 8):
+                block = MCTSBuilder(self.env, root_search=root_search)
+                start_time = time.time()
+                root_node = block.run_batch(
+                    policy, env_snapshot=snapshot_v0, batch_size=batch_size,
+                    leaf_batch_size=leaf_batch_size, time_budget_ms=50,
+                )
+                self.assertLess(time.time() - start_time, 0.5)
+                completed = block.completed_simulations
+                self.assertGreater(completed, 0)
+                self.assertLess(completed, 10**6)
+                self.assertEqual(block.stats.simulations, completed)
+                self.assertAlmostEqual(sum(root_node.q_table), 1.0)
+
+    def test_mcts_search_horizon(self):
+        horizon = 5
+        env = FastTradingEnv(name=self.stock_name, days=120, window=self.days)
+        policy = RandomTradingPolicy(action_options=env.action_options())
+        snapshot = env.snapshot()
+        for leaf_batch_size in (1, 8):
+            block = MCTSBuilder(env, debug=False, horizon=horizon)
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot, batch_size=40, leaf_batch_size=leaf_batch_size
+            )
+            summary = block.stats_summary()
+            # simulations stop at horizon instead of episode end
+            self.assertLessEqual(len(summary['depth_hist']), horizon + 1)
+            self.assertGreater(summary['bootstraps'], 0)
+            self.assertEqual(summary['simulations'], 40)
+            self.assertEqual(root_node._state.shape, (self.days, env.data.shape[1]))
+
+    def test_mcts_transposition(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        for leaf_batch_size in (1, 8):
+            block = MCTSBuilder(self.env, debug=False, transposition=True)
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot_v0, batch_size=50, leaf_batch_size=leaf_batch_size
+            )
+            store = root_node._store
+            # every node registered once by its state key
+            self.assertEqual(len(store.transpositions), store.size)
+            nodes, actions = np.nonzero(store.children[:store.size] >= 0)
+            children = store.children[nodes, actions]
+            self.assertTrue((store.level[children] == store.level[nodes] + 1).all())
+            self.assertTrue(root_node.q_table)
+
+    def test_transposition_nav_decimals(self):
+        np.random.seed(0)
+        context = SearchContext(env=self.env, transposition=True)
+        root_node = TradingNode(context=context)
+        trading_cost = 1.0 - self.env.trading_cost_pct_change
+        checked = 0
+        for _ in range(50):
+            self.env.reset()
+            snapshot = self.env.snapshot()
+            keys, navs = [], []
+            # both paths end in cash at the same step, only nav differs
+            for actions in ([1, 0, 0], [0, 1, 0]):
+                self.env.recover(snapshot)
+                for action in actions:
+                    self.env.step(action, with_obs=False)
+                keys.append(root_node._state_key())
+                navs.append(self.env.position_nav()[1])
+            if abs(navs[0] - navs[1]) > trading_cost:
+                # states whose returns differ by more than trading cost are not merged
+                self.assertNotEqual(keys[0], keys[1])
+                checked += 1
+        self.assertGreater(checked, 0)
+
+    def test_mcts_node_budget(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        max_nodes = 64
+        block = MCTSBuilder(self.env, debug=False, max_nodes=max_nodes)
+        root_node = block.run_batch(policy, env_snapshot=snapshot_v0, batch_size=100)
+        store = root_node._store
+        self.assertLessEqual(store.node_count, max_nodes)
+        self.assertLessEqual(store.capacity, max_nodes)
+        self.assertEqual(store.alive[:store.size].sum(), store.node_count)
+        # every alive child link points to alive node
+        children = store.children[:store.size][store.alive[:store.size]]
+        self.assertTrue(store.alive[children[children >= 0]].all())
+
+    def test_mcts_release_siblings(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        block = MCTSBuilder(self.env, debug=False)
+        root_node = block.run_batch(
+            policy, env_snapshot=snapshot_v0, batch_size=40, leaf_batch_size=8
+        )
+        store = root_node._store
+        before = store.node_count
+        action = int(np.argmax(root_node.q_table))
+        next_root = root_node.set_next_root(action)
+        self.assertTrue(next_root.is_root)
+        self.assertLess(store.node_count, before)
+        # freed ids are recycled by next expansion
+        free_count = before - store.node_count
+        block = MCTSBuilder(self.env, init_node=next_root, debug=False)
+        fast_moving(self.env, HoldTradingPolicy(self.env.action_options(), action), steps=1)
+        block.run_batch(policy, env_snapshot=self.env.snapshot(), batch_size=1, leaf_batch_size=2)
+        self.assertLessEqual(store.size, before)
+        self.assertTrue(free_count)
+
+    def test_root_parallel(self):
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        with RootParallelSearch(self.env, policy, workers=2) as search:
+            root_node = search.run_batch(
+                batch_size=20, env_snapshot=snapshot_v0, leaf_batch_size=4
+            )
+            self.assertEqual(root_node._store.N[root_node._nid].sum(), 20)
+            self.assertAlmostEqual(sum(root_node.q_table), 1.0)
+            # search again with the same workers
+            root_node = search.run_batch(batch_size=10, env_snapshot=snapshot_v0)
+            self.assertTrue(root_node.q_table)
+        # budget is split exactly, `seed` is not passed to builders of workers
+        with RootParallelSearch(self.env, policy, workers=3, seed=1) as search:
+            for batch_size in (1, 7):
+                root_node = search.run_batch(
+                    batch_size=batch_size, env_snapshot=snapshot_v0, leaf_batch_size=4
+                )
+                self.assertEqual(root_node._store.N[root_node._nid].sum(), batch_size)
+
+    def test_save_load_tree(self):
+        import os
+        import tempfile
+        policy = RandomTradingPolicy(action_options=self.env.action_options())
+        self.env.reset()
+        snapshot_v0 = self.env.snapshot()
+        tree_path = os.path.join(tempfile.mkdtemp(), 'test.tree')
+        for transposition in (False, True):
+            block = MCTSBuilder(self.env, transposition=transposition)
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot_v0, batch_size=30, leaf_batch_size=4
+            )
+            size = save_tree(root_node, tree_path, meta={'name': self.env.name})
+            self.assertEqual(size, root_node._store.node_count)
+            self.assertEqual(read_header(tree_path)['meta']['name'], self.env.name)
+            context = SearchContext(env=self.env, transposition=transposition)
+            loaded_node = load_tree(tree_path, context)
+            self.assertEqual(loaded_node.q_table, root_node.q_table)
+            self.assertEqual(loaded_node._store.node_count, size)
+            if transposition:
+                self.assertEqual(len(loaded_node._store.transpositions), size)
+            # warm start from loaded tree
+            block = MCTSBuilder(self.env, init_node=loaded_node)
+            root_node = block.run_batch(
+                policy, env_snapshot=snapshot_v0, batch_size=30, leaf_batch_size=4
+            )
+            self.assertEqual(root_node._store.N[root_node._nid].sum(), 60)
+        os.remove(tree_path)
+
     def test_mcts_start_from_snapshot(self):
         # buy and hold policy
         hold_policy = HoldTradingPolicy(action_options=self.env.action_options(), action_idx=1)
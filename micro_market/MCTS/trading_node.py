@@ -1,78 +1,97 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import time
 import numpy as np
 
 from base_node import BaseNode
+from tree_store import TreeStore
 
 
-class Edge(object):
-    def __init__(self, prior_p, up, down=None):
-        # relation data
-        self._up_node = up
-        self._down_node = down
-        # internal data
-        self._visit_count = 0
-        self._total_reward = 0.0
-        self._mean_reward = 0.0
-        self._action_probability = prior_p
+class TradingNode(BaseNode):
+    """
+        light-weight handle of one node in a TreeStore
+        all N/W/Q/P statistics live in the store arrays, indexed by node id,
+        env, counters and config of the tree live in its SearchContext
+    """
 
-    def backup(self, v):
-        self._total_reward += v
-        self._visit_count += 1
-        self._mean_reward = self._total_reward / self._visit_count
+    def __init__(self, context, prior_ps=None, level=0, store=None, node_id=None, depth=0):
+        if store is None:
+            # create new tree with self as root node
+            store = TreeStore(
+                action_size=len(context.env.action_options()), episolon=context.episolon,
+                transposition=context.transposition, max_nodes=context.max_nodes,
+                rng=context.rng,
+            )
+            key = context.env.state_key(context.nav_decimals) if context.transposition else None
+            node_id = store.add_node(
+                prior_ps=prior_ps, level=level, state=context.env.state_ref(), key=key
+            )
+        self._context = context
+        self._store = store
+        self._nid = node_id
+        # depth from where current simulation started
+        self._depth = depth
 
+    def get_episode_count(self):
+        return self._context.episode_count
 
-class TradingNode(BaseNode):
-    # global settings
-    env = None
-    episode_count = 0
-
-    @classmethod
-    def get_episode_count(cls):
-        return cls.episode_count
-
-    def __init__(self, state, up_edge=None, prior_ps=None, level=0, episolon=0.25):
-        self._state = state
-        self._up_edge = up_edge
-        self._level = level
-        action_size = len(self.env.action_options())
-        if prior_ps is None:
-            prior_ps = [1.0/action_size for i in range(action_size)]
-        noise_prior_ps = np.array(prior_ps) * (1 - episolon) + \
-            np.random.dirichlet((0.5, 0.5)) * episolon
-        self._down_edges = [Edge(prior_p=noise_prior_ps[i], up=self) for i in range(action_size)]
+    def __eq__(self, other):
+        return isinstance(other, TradingNode) and \
+            self._store is other._store and self._nid == other._nid
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self._store), self._nid))
+
+    def _node(self, nid, depth=0):
+        return TradingNode(context=self._context, store=self._store, node_id=nid, depth=depth)
+
+    @property
+    def _state(self):
+        # rebuild obs from state reference, nodes do not keep obs
+        return self._context.env.observations(
+            data_step=int(self._store.state_step[self._nid]),
+            idx=int(self._store.state_idx[self._nid]),
+        )
+
+    @property
+    def _level(self):
+        return int(self._store.level[self._nid])
 
     # DEBUG helper
     #############################
-    def draw_graph(self, node, graph_node):
-        for action, down_edge in enumerate(node._down_edges):
+    def draw_graph(self, nid, graph_node):
+        store = self._store
+        for action in range(store.action_size):
             c = graph_node.add_child(name=unicode(action))
             c.add_features(
-                N=down_edge._visit_count,
-                W=down_edge._total_reward,
-                Q=down_edge._mean_reward,
-                P=down_edge._action_probability,
+                N=store.N[nid, action],
+                W=store.W[nid, action],
+                Q=store.Q[nid, action],
+                P=store.P[nid, action],
             )
-            if down_edge._down_node:
-                self.draw_graph(down_edge._down_node, c)
+            if store.children[nid, action] >= 0:
+                self.draw_graph(store.children[nid, action], c)
 
     def show_graph(self, name=None):
         from ete3 import Tree
         t = Tree()
-        self.draw_graph(self, t)
+        self.draw_graph(self._nid, t)
         # if name:
         #    t.render(file_name=name)
         # print(t.get_ascii(attributes=['name', 'N', 'W', 'Q', 'P']))
         print(t.get_ascii(attributes=['name', 'N', 'Q']))
 
     def find_leaf_node(self):
-        if self.is_leaf:
-            return self
-        # find sub edge
-        for e in self._down_edges:
-            if e._down_node:
-                return e._down_node.find_leaf_node()
+        nid = self._nid
+        while not self._store.is_leaf(nid):
+            # find sub edge
+            children = self._store.children[nid]
+            nid = children[children >= 0][0]
+        return self._node(nid)
 
     def show_final_state(self):
         leaf_node = self.find_leaf_node()
@@ -82,92 +101,252 @@ class TradingNode(BaseNode):
 
     @property
     def is_leaf(self):
-        return all([not e._down_node for e in self._down_edges])
+        return self._store.is_leaf(self._nid)
 
     @property
     def is_root(self):
-        return bool(not self._up_edge)
+        return bool(self._store.parent[self._nid] < 0)
 
     @property
     def q_table(self, t=0.98):
+        # improved policy target of gumbel root search
+        target = self._context.root_targets.get(self._nid)
+        if target is not None:
+            return target
         # according to : agz nature
         # do actual play based on current node
         # return pai(action|state)
-        _c = [np.power(e._visit_count, 1.0/t) for e in self._down_edges]
-        _sum_c = sum(_c)
-        return [i/_sum_c for i in _c]
+        return self._store.q_table(self._nid, t=t)
+
+    def evaluate_prior(self, policy):
+        """evaluate node with policy as its prior and value, root nodes are created without"""
+        state = (int(self._store.state_idx[self._nid]), int(self._store.state_step[self._nid]))
+        p, v = self._evaluate(policy, self._state, state)
+        self._store.P[self._nid] = p
+        self._store.V[self._nid] = v
 
     def set_next_root(self, action):
-        next_root = self._down_edges[action]._down_node
+        """
+            move root to the child of `action`, current node and all siblings are released,
+            so handles of them are invalid after this call
+        """
+        self._context.root_targets.pop(self._nid, None)
+        next_nid = self._store.children[self._nid, action]
+        if next_nid < 0:
+            self._store.release(self._nid)
+            return None
         # clean up
-        next_root._up_edge = None
-        # gc.collect()
-        return next_root
+        self._store.set_root(next_nid, old_root=self._nid)
+        return self._node(next_nid)
 
     def set_env(self, env):
-        # override class attribute 'env'
-        self.__class__.env = env
+        # env of whole tree
+        self._context.env = env
+
+    def _endgame_solve(self):
+        """return (best action, exact value) if env is in endgame levels, else None"""
+        context = self._context
+        if not context.in_endgame(context.env):
+            return None
+        values = context.endgame_solver.solve_env(context.env)
+        action = int(np.argmax(values))
+        return action, values[action]
 
     def _select(self, threshold_level=10):
-        if self._level > self.__class__.env.days - threshold_level:
+        if self._level > self._context.env.days - threshold_level:
             return self._traverse_select()
         return self._agz_select()
 
-    def _agz_select(self, c_puct=0.1):
-        # refer to: PUCT algorithm
-        total_visit_count = sum([e._visit_count for e in self._down_edges])
-        vs = [
-            e._mean_reward + c_puct * e._action_probability *
-            np.sqrt(total_visit_count * 1.0) / (1.0 + e._visit_count)
-            for e in self._down_edges
-        ]
-        if vs[1:] == vs[:-1]:
-            return np.random.choice(range(len(vs)))
-        return np.argmax(vs)
+    def _agz_select(self):
+        return self._store.puct_select(self._nid, c_puct=self._context.c_puct)
 
     def _traverse_select(self):
         # use traverse select in the last `threshold_level` levels
-        vcs = []
-        for action, e in enumerate(self._down_edges):
-            vcs.append(e._visit_count)
-            if not e._down_node:
-                return action
-        if vcs[1:] == vcs[:-1]:
-            return np.random.choice(range(len(vcs)))
-        return np.argmin(vcs)
+        return self._store.traverse_select(self._nid)
+
+    def _at_horizon(self, depth):
+        horizon = self._context.horizon
+        return bool(horizon) and depth >= horizon
+
+    def _state_key(self):
+        if self._store.transpositions is None:
+            return None
+        return self._context.env.state_key(self._context.nav_decimals)
+
+    def _evaluate(self, policy, obs, state):
+        table = self._context.eval_table
+        evaluation = table.lookup(state) if table else None
+        if evaluation is None:
+            start_time = time.time()
+            evaluation = policy.evaluate(obs)
+            self._context.stats.add_evaluation(time.time() - start_time)
+        return evaluation
 
     def _backup(self, v):
-        current_node = self
-        while current_node and not current_node.is_root:
-            current_node._up_edge.backup(v)
-            current_node = current_node._up_edge._up_node
+        # backup along current simulation path
+        self._store.backup_path(self._depth, v)
 
-    def step(self, policy):
+    def step(self, policy, action=None):
         """
             Args:
                 policy (Policy): policy object for evaluation
+                action (int): take this action instead of selecting one
             Returns:
                 TradingNode: next node if exist (None if done)
         """
-        NodeClass = self.__class__
-        action = self._agz_select()
-        # run in env
-        obs, reward, done, _ = NodeClass.env.step(action)
-        next_edge = self._down_edges[action]
-        if not next_edge._down_node:
-            # evaluate with policy
-            p, v = policy.evaluate(obs)
-            # expand new node
-            next_node = NodeClass(state=obs, up_edge=next_edge, prior_ps=p, level=self._level+1)
-            next_edge._down_node = next_node
+        context = self._context
+        store = self._store
+        stats = context.stats
+        solved = self._endgame_solve() if action is None else None
+        if solved:
+            # endgame: backup exact value of best action instead of simulating to the end
+            action, v = solved
+            store.record(self._depth, self._nid, action)
+            store.backup_path(self._depth+1, v)
+            context.episode_count += 1
+            stats.endgame_solves += 1
+            stats.add_depth(self._depth+1)
+            return None
+        if action is None:
+            action = self._agz_select()
+        next_nid = store.children[self._nid, action]
+        # run in env, obs is only needed to expand new node
+        start_time = time.time()
+        obs, reward, done, _ = context.env.step(action, with_obs=next_nid < 0)
+        stats.env_step_time += time.time() - start_time
+        store.record(self._depth, self._nid, action)
+        if next_nid < 0:
+            key = self._state_key()
+            next_nid = store.find_transposition(key)
+            if next_nid >= 0:
+                # same state reached from another path, share its node
+                store.link(self._nid, action, next_nid)
+                v = store.V[next_nid]
+                stats.transposition_hits += 1
+            else:
+                # evaluate with policy
+                state = context.env.state_ref()
+                p, v = self._evaluate(policy, obs, state)
+                stats.expansions += 1
+                # expand new node
+                next_nid = store.add_node(
+                    prior_ps=p, level=self._level+1, parent=self._nid, action=action,
+                    state=state, value=v, key=key,
+                )
+            next_node = self._node(next_nid, depth=self._depth+1)
             # backup
             next_node._backup(v)
         else:
             # reuse exist node
-            next_node = next_edge._down_node
+            next_node = self._node(next_nid, depth=self._depth+1)
+            stats.reuses += 1
+            if not done and self._at_horizon(self._depth+1):
+                # bootstrap from value of reached node instead of simulating deeper
+                next_node._backup(store.V[next_nid])
 
         if done:
             # episode done, reach leaf node
-            NodeClass.episode_count += 1
+            context.episode_count += 1
+            stats.add_depth(self._depth+1)
+            next_node = None
+        elif self._at_horizon(self._depth+1):
+            # search horizon reached, value of new node has been backed up
+            stats.bootstraps += 1
+            stats.add_depth(self._depth+1)
             next_node = None
         return next_node
+
+    def select_leaf(self, virtual_loss=1.0, action=None):
+        """
+            descend from current node with virtual loss until an unexpanded edge or done,
+            first edge is `action` if given
+            Returns:
+                tuple: (path nodes, path actions, leaf obs, leaf state ref, leaf state key,
+                    solved value)
+                    leaf obs is None if episode done on an exist node, solved in endgame
+                    or search horizon reached on an exist node (solved value is its V)
+        """
+        context = self._context
+        store = self._store
+        stats = context.stats
+        nid = self._nid
+        nodes, actions = [], []
+        forced_action = action
+        while True:
+            solved = self._endgame_solve() if forced_action is None else None
+            if solved:
+                action, v = solved
+                nodes.append(nid)
+                actions.append(action)
+                store.add_virtual_loss(nid, action)
+                context.episode_count += 1
+                stats.endgame_solves += 1
+                stats.add_depth(self._depth+len(nodes))
+                return nodes, actions, None, None, None, v
+            action = forced_action
+            forced_action = None
+            if action is None:
+                action = store.puct_select(nid, c_puct=context.c_puct, virtual_loss=virtual_loss)
+            next_nid = store.children[nid, action]
+            start_time = time.time()
+            obs, reward, done, _ = context.env.step(action, with_obs=next_nid < 0)
+            stats.env_step_time += time.time() - start_time
+            nodes.append(nid)
+            actions.append(action)
+            store.add_virtual_loss(nid, action)
+            key = None
+            if next_nid < 0:
+                key = self._state_key()
+                next_nid = store.find_transposition(key)
+                if next_nid >= 0:
+                    store.link(nid, action, next_nid)
+                    stats.transposition_hits += 1
+            else:
+                stats.reuses += 1
+            at_horizon = not done and self._at_horizon(self._depth+len(nodes))
+            if done or next_nid < 0 or at_horizon:
+                stats.add_depth(self._depth+len(nodes))
+            if at_horizon:
+                stats.bootstraps += 1
+            if done:
+                context.episode_count += 1
+            if next_nid < 0:
+                return nodes, actions, obs, context.env.state_ref(), key, None
+            if done:
+                return nodes, actions, None, None, None, None
+            if at_horizon:
+                # bootstrap from value of reached node, backed up like a solved value
+                return nodes, actions, None, None, None, store.V[next_nid]
+            nid = next_nid
+
+    def expand_leaves(self, leaves, ps, vs):
+        """
+            expand leaves from `select_leaf` with batched evaluation (ps, vs), then backup
+            ps/vs are aligned with leaves which have obs
+        """
+        store = self._store
+        eval_idx = 0
+        for nodes, actions, obs, state, key, solved_v in leaves:
+            store.revert_virtual_loss(nodes, actions)
+            if solved_v is not None:
+                # exact value from endgame solver
+                store.backup(nodes, actions, solved_v)
+                continue
+            if obs is None:
+                # reach done with exist node, nothing to backup
+                continue
+            p, v = ps[eval_idx], vs[eval_idx]
+            eval_idx += 1
+            leaf_nid, leaf_action = nodes[-1], actions[-1]
+            if store.children[leaf_nid, leaf_action] < 0:
+                next_nid = store.find_transposition(key)
+                if next_nid >= 0:
+                    # expanded by another leaf of this batch
+                    store.link(leaf_nid, leaf_action, next_nid)
+                else:
+                    self._context.stats.expansions += 1
+                    store.add_node(
+                        prior_ps=p, level=store.level[leaf_nid]+1, parent=leaf_nid,
+                        action=leaf_action, state=state, value=v, key=key,
+                    )
+            store.backup(nodes, actions, v)
@@ -0,0 +1,117 @@
+# coding: utf-8
+"""
+    compact binary format of MCTS trees, all arrays can be memory-mapped
+
+    layout: MAGIC | header length (uint32) | json header | 64 bytes aligned arrays
+"""
+from __future__ import unicode_literals
+
+import os
+import json
+import struct
+import numpy as np
+
+from tree_store import TreeStore
+from trading_node import TradingNode
+
+MAGIC = b'MCTSTREE'
+VERSION = 2
+ALIGNMENT = 64
+
+
+def tree_file_name(name, idx, step):
+    return '{name}.{idx}.{step}.tree'.format(name=name, idx=idx, step=step)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_tree(root_node, file_path, meta=None):
+    """
+        save sub tree under `root_node` to `file_path`, return saved node count
+        Args:
+            meta (dict): json serializable info of tree, e.g. stock name, idx and step
+    """
+    store = root_node._store
+    arrays, keys = store.export(root_node._nid)
+    if keys is not None:
+        # state key: (idx, step, position, nav)
+        arrays['keys'] = np.array(
+            [key if key is not None else (-1, -1, -1, np.nan) for key in keys], dtype=np.float64
+        )
+    header = {
+        'version': VERSION,
+        'meta': meta or {},
+        'arrays': {},
+    }
+    names = sorted(arrays.keys())
+    header_len = 0
+    while True:
+        # array offsets depend on header size, repeat until header size is stable
+        offset = _align(len(MAGIC) + 4 + header_len)
+        for name in names:
+            arr = arrays[name]
+            header['arrays'][name] = {
+                'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset,
+            }
+            offset = _align(offset + arr.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+        if len(header_bytes) == header_len:
+            break
+        header_len = len(header_bytes)
+    # temp file of this process, concurrent writers of the same tree do not mix up
+    tmp_path = '{p}.{pid}.tmp'.format(p=file_path, pid=os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            f.seek(header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(arrays[name]).tobytes())
+        f.truncate(offset)
+    os.rename(tmp_path, file_path)
+    return arrays['parent'].shape[0]
+
+
+def read_header(file_path):
+    with open(file_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('[{p}] is not a tree file'.format(p=file_path))
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError('unsupported tree file version: {v}'.format(v=header['version']))
+    return header
+
+
+def load_tree(file_path, context, mmap=True):
+    """
+        load tree as root node for `MCTSBuilder(init_node=...)`,
+        arrays are memory-mapped copy-on-write, so pages are only read when visited
+    """
+    header = read_header(file_path)
+    arrays = dict()
+    for name, info in header['arrays'].items():
+        if mmap:
+            arrays[name] = np.memmap(
+                file_path, dtype=np.dtype(str(info['dtype'])), mode='c',
+                offset=info['offset'], shape=tuple(info['shape']),
+            )
+        else:
+            with open(file_path, 'rb') as f:
+                f.seek(info['offset'])
+                arrays[name] = np.fromfile(
+                    f, dtype=np.dtype(str(info['dtype'])), count=int(np.prod(info['shape']))
+                ).reshape(info['shape'])
+    keys = None
+    if 'keys' in arrays:
+        keys = [
+            (int(k[0]), int(k[1]), int(k[2]), float(k[3])) if k[0] >= 0 else None
+            for k in arrays.pop('keys').tolist()
+        ]
+    store = TreeStore.from_arrays(
+        arrays, keys=keys, episolon=context.episolon, transposition=context.transposition,
+        max_nodes=context.max_nodes, rng=context.rng,
+    )
+    return TradingNode(context=context, store=store, node_id=0)
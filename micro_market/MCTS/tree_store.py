@@ -0,0 +1,325 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import numpy as np
+
+
+def _extend(arr, capacity, fill):
+    new_arr = np.empty((capacity, ) + arr.shape[1:], dtype=arr.dtype)
+    new_arr[:arr.shape[0]] = arr
+    new_arr[arr.shape[0]:] = fill
+    return new_arr
+
+
+class TreeStore(object):
+    """
+        struct-of-arrays storage for MCTS tree
+        node data is indexed by node id, edge data is indexed by [node id, action]
+        released node ids are recycled through a free list
+    """
+    EVICT_RATIO = 0.1  # fraction of node budget evicted at once
+    # arrays needed to rebuild a tree, see `export` and `from_arrays`
+    PERSIST_ARRAYS = (
+        'refs', 'parent', 'parent_action', 'level', 'V', 'state_idx', 'state_step',
+        'children', 'N', 'W', 'Q', 'P',
+    )
+
+    def __init__(
+        self, action_size, capacity=1024, episolon=0.25, alpha=0.5, transposition=False,
+        max_nodes=None, rng=None,
+    ):
+        assert(action_size > 0 and capacity > 0)
+        if max_nodes:
+            capacity = min(capacity, max_nodes)
+        self.action_size = action_size
+        self.size = 0  # high-water mark of used node ids
+        self.max_nodes = max_nodes
+        self._episolon = episolon
+        self._alpha = alpha
+        self._rng = rng or np.random.RandomState()
+        self._free_ids = []
+        # state key -> node id, nodes reached by different paths are merged (DAG)
+        self.transpositions = dict() if transposition else None
+        self._node_keys = dict()
+        # node data
+        self.alive = np.empty(0, dtype=np.bool_)
+        self.refs = np.empty(0, dtype=np.int32)  # count of edges pointing to node
+        self.parent = np.empty(0, dtype=np.int32)  # first parent only when merged
+        self.parent_action = np.empty(0, dtype=np.int8)
+        self.level = np.empty(0, dtype=np.int32)
+        self.V = np.empty(0, dtype=np.float64)  # value evaluated at expansion
+        # env state reference (data idx, step), obs is rebuilt from env on demand
+        self.state_idx = np.empty(0, dtype=np.int32)
+        self.state_step = np.empty(0, dtype=np.int32)
+        # edge data
+        self.children = np.empty((0, action_size), dtype=np.int32)
+        self.N = np.empty((0, action_size), dtype=np.int64)  # visit count
+        self.W = np.empty((0, action_size), dtype=np.float64)  # total reward
+        self.Q = np.empty((0, action_size), dtype=np.float64)  # mean reward
+        self.P = np.empty((0, action_size), dtype=np.float64)  # prior probability
+        self.VL = np.empty((0, action_size), dtype=np.int64)  # pending virtual loss count
+        self._noise = np.empty((0, action_size), dtype=np.float64)
+        # current simulation path
+        self.path_nodes = np.empty(0, dtype=np.int32)
+        self.path_actions = np.empty(0, dtype=np.int32)
+        self._grow(capacity)
+
+    @property
+    def capacity(self):
+        return self.parent.shape[0]
+
+    @property
+    def node_count(self):
+        return self.size - len(self._free_ids)
+
+    @property
+    def nbytes(self):
+        return sum([
+            arr.nbytes for arr in (
+                self.alive, self.refs, self.parent, self.parent_action, self.level, self.V,
+                self.state_idx, self.state_step, self.children, self.N, self.W, self.Q, self.P, self.VL, self._noise,
+            )
+        ])
+
+    def export(self, root):
+        """
+            export sub tree under `root` with compact node ids (root is 0)
+            Returns:
+                tuple: (dict of PERSIST_ARRAYS, list of node state keys or None)
+        """
+        # breadth first walk, DAG nodes are visited once
+        seen = np.zeros(self.size, dtype=np.bool_)
+        seen[root] = True
+        frontier = np.array([root], dtype=np.int32)
+        order = [frontier]
+        while frontier.shape[0]:
+            children = self.children[frontier].ravel()
+            children = np.unique(children[children >= 0])
+            frontier = children[~seen[children]]
+            seen[frontier] = True
+            order.append(frontier)
+        nids = np.concatenate(order)
+        remap = np.full(self.size + 1, -1, dtype=np.int32)  # remap[-1] stays -1
+        remap[nids] = np.arange(nids.shape[0])
+        arrays = dict([(name, getattr(self, name)[nids]) for name in self.PERSIST_ARRAYS])
+        arrays['children'] = remap[arrays['children']]
+        arrays['parent'] = remap[arrays['parent']]
+        arrays['parent'][0] = -1
+        arrays['refs'] = np.bincount(
+            arrays['children'][arrays['children'] >= 0], minlength=nids.shape[0]
+        ).astype(self.refs.dtype)
+        keys = None
+        if self.transpositions is not None:
+            keys = [self._node_keys.get(nid) for nid in nids.tolist()]
+        return arrays, keys
+
+    @classmethod
+    def from_arrays(cls, arrays, keys=None, **kwargs):
+        """build store on exported arrays (may be memory-mapped), arrays are copied on grow"""
+        size = arrays['parent'].shape[0]
+        store = cls(action_size=arrays['children'].shape[1], capacity=1, **kwargs)
+        for name in cls.PERSIST_ARRAYS:
+            setattr(store, name, arrays[name])
+        store.alive = np.ones(size, dtype=np.bool_)
+        store.VL = np.zeros(arrays['children'].shape, dtype=store.VL.dtype)
+        store._noise = store._rng.dirichlet((store._alpha, ) * store.action_size, size=size)
+        store.size = size
+        if store.transpositions is not None and keys:
+            for nid, key in enumerate(keys):
+                if key is not None:
+                    store.transpositions[key] = nid
+                    store._node_keys[nid] = key
+        return store
+
+    def _grow(self, capacity):
+        old_capacity = self.capacity
+        self.alive = _extend(self.alive, capacity, False)
+        self.refs = _extend(self.refs, capacity, 0)
+        self.parent = _extend(self.parent, capacity, -1)
+        self.parent_action = _extend(self.parent_action, capacity, -1)
+        self.level = _extend(self.level, capacity, 0)
+        self.V = _extend(self.V, capacity, 0.0)
+        self.state_idx = _extend(self.state_idx, capacity, -1)
+        self.state_step = _extend(self.state_step, capacity, -1)
+        self.children = _extend(self.children, capacity, -1)
+        self.N = _extend(self.N, capacity, 0)
+        self.W = _extend(self.W, capacity, 0.0)
+        self.Q = _extend(self.Q, capacity, 0.0)
+        self.P = _extend(self.P, capacity, 0.0)
+        self.VL = _extend(self.VL, capacity, 0)
+        # draw dirichlet noise for the whole block at once
+        self._noise = _extend(self._noise, capacity, 0.0)
+        self._noise[old_capacity:] = self._rng.dirichlet(
+            (self._alpha, ) * self.action_size, size=capacity - old_capacity
+        )
+
+    def _grow_path(self, depth):
+        capacity = max(depth, self.path_nodes.shape[0] * 2, 32)
+        self.path_nodes = _extend(self.path_nodes, capacity, -1)
+        self.path_actions = _extend(self.path_actions, capacity, -1)
+
+    def _alloc(self, protect=-1):
+        if not self._free_ids and self.max_nodes and self.size >= self.max_nodes:
+            # node budget reached, recycle least visited leaves
+            self.evict(max(1, int(self.max_nodes * self.EVICT_RATIO)), protect=protect)
+        if self._free_ids:
+            nid = self._free_ids.pop()
+            self.children[nid] = -1
+            self.N[nid] = 0
+            self.W[nid] = 0.0
+            self.Q[nid] = 0.0
+            self.VL[nid] = 0
+            return nid
+        if self.size >= self.capacity:
+            capacity = self.capacity * 2
+            if self.max_nodes and self.size < self.max_nodes:
+                capacity = min(capacity, self.max_nodes)
+            self._grow(capacity)
+        nid = self.size
+        self.size += 1
+        return nid
+
+    def add_node(self, prior_ps=None, level=0, parent=-1, action=-1, state=None, value=0.0, key=None):
+        """
+            Args:
+                state (tuple): env state reference (data idx, step), see `env.state_ref`
+        """
+        nid = self._alloc(protect=parent)
+        self.alive[nid] = True
+        self.refs[nid] = 1 if parent >= 0 else 0
+        self.parent[nid] = parent
+        self.parent_action[nid] = action
+        self.level[nid] = level
+        self.V[nid] = value
+        self.state_idx[nid], self.state_step[nid] = state or (-1, -1)
+        if prior_ps is None:
+            self.P[nid] = 1.0 / self.action_size
+        else:
+            self.P[nid] = prior_ps
+        self.P[nid] = self.P[nid] * (1 - self._episolon) + self._noise[nid] * self._episolon
+        if parent >= 0:
+            self.children[parent, action] = nid
+        if key is not None and self.transpositions is not None:
+            self.transpositions[key] = nid
+            self._node_keys[nid] = key
+        return nid
+
+    def _free(self, nid):
+        self.alive[nid] = False
+        self.parent[nid] = -1
+        key = self._node_keys.pop(nid, None)
+        if key is not None:
+            del self.transpositions[key]
+        self._free_ids.append(nid)
+
+    def release(self, nid):
+        """release node and all sub nodes which are not referenced by others"""
+        stack = [nid]
+        while stack:
+            nid = stack.pop()
+            children = self.children[nid]
+            children = children[children >= 0]
+            np.subtract.at(self.refs, children, 1)
+            stack.extend(np.unique(children[self.refs[children] <= 0]).tolist())
+            self._free(nid)
+
+    def unlink(self, parent, action):
+        """cut edge (parent, action) and release sub nodes, edge stats are kept"""
+        nid = self.children[parent, action]
+        if nid < 0:
+            return
+        self.children[parent, action] = -1
+        self.refs[nid] -= 1
+        if self.refs[nid] <= 0:
+            self.release(nid)
+
+    def set_root(self, nid, old_root):
+        """make `nid` new root, release `old_root` and all siblings of `nid`"""
+        self.refs[nid] += 1  # keep new root alive while releasing
+        self.release(old_root)
+        self.refs[nid] = 0
+        self.parent[nid] = -1
+
+    def evict(self, count, protect=-1):
+        """evict at most `count` least visited leaves"""
+        size = self.size
+        parent, parent_action = self.parent[:size], self.parent_action[:size]
+        candidates = self.alive[:size] & (self.refs[:size] == 1) & (parent >= 0)
+        # leaf without pending virtual loss, merged nodes are only evicted with their parent
+        candidates &= ~np.any(self.children[:size] >= 0, axis=1)
+        candidates &= ~np.any(self.VL[:size] > 0, axis=1)
+        candidates &= self.children[np.maximum(parent, 0), parent_action] == np.arange(size)
+        if protect >= 0:
+            candidates[protect] = False
+        nids = np.flatnonzero(candidates)
+        visits = self.N[parent[nids], parent_action[nids]]
+        nids = nids[np.argsort(visits, kind='mergesort')[:count]]
+        for nid in nids.tolist():
+            self.children[parent[nid], parent_action[nid]] = -1
+            self._free(nid)
+        return nids.shape[0]
+
+    def find_transposition(self, key):
+        if self.transpositions is None or key is None:
+            return -1
+        return self.transpositions.get(key, -1)
+
+    def link(self, parent, action, nid):
+        """link edge (parent, action) to an exist node reached from another path"""
+        self.children[parent, action] = nid
+        self.refs[nid] += 1
+
+    def is_leaf(self, nid):
+        return not np.any(self.children[nid] >= 0)
+
+    def record(self, depth, nid, action):
+        """record edge (nid, action) at `depth` of current simulation path"""
+        if depth >= self.path_nodes.shape[0]:
+            self._grow_path(depth + 1)
+        self.path_nodes[depth] = nid
+        self.path_actions[depth] = action
+
+    def backup(self, nodes, actions, v):
+        # levels strictly increase along a simulation path, so nodes in the path are unique
+        # (even in DAG mode) and fancy indexing is safe here. backup always follows the
+        # recorded path instead of parent links, since merged nodes have many parents
+        self.W[nodes, actions] += v
+        self.N[nodes, actions] += 1
+        self.Q[nodes, actions] = self.W[nodes, actions] / self.N[nodes, actions]
+
+    def backup_path(self, depth, v):
+        """backup v along the first `depth` edges of current simulation path"""
+        self.backup(self.path_nodes[:depth], self.path_actions[:depth], v)
+
+    def add_virtual_loss(self, nodes, actions):
+        self.VL[nodes, actions] += 1
+
+    def revert_virtual_loss(self, nodes, actions):
+        self.VL[nodes, actions] -= 1
+
+    def puct_select(self, nid, c_puct=0.1, virtual_loss=0.0):
+        # refer to: PUCT algorithm
+        n, q = self.N[nid], self.Q[nid]
+        vl = self.VL[nid]
+        if virtual_loss and np.any(vl):
+            # pending simulations count as visits which lost `virtual_loss` each
+            n = n + vl
+            q = (self.W[nid] - vl * virtual_loss) / np.maximum(n, 1)
+        vs = q + c_puct * self.P[nid] * np.sqrt(n.sum() * 1.0) / (1.0 + n)
+        if np.all(vs == vs[0]):
+            return self._rng.randint(self.action_size)
+        return int(np.argmax(vs))
+
+    def traverse_select(self, nid):
+        missing = np.flatnonzero(self.children[nid] < 0)
+        if missing.shape[0]:
+            return int(missing[0])
+        n = self.N[nid]
+        if np.all(n == n[0]):
+            return self._rng.randint(self.action_size)
+        return int(np.argmin(n))
+
+    def q_table(self, nid, t=0.98):
+        # according to : agz nature
+        _c = np.power(self.N[nid], 1.0/t)
+        return (_c / _c.sum()).tolist()
@@ -3,15 +3,27 @@
 CPU_CORES = 2
 
 EPISODE_LENGTH = 30
-FEATURE_NUM = 5
+OBS_WINDOW = EPISODE_LENGTH  # model input rows, shorter than episode for trailing window obs
+FEATURES = ('open', 'high', 'low', 'close', 'volume')  # env obs features, see envs/features
+FEATURE_NUM = len(FEATURES)
+FEATURE_CACHE_DIR = './feature_cache'
 DATA_BUFFER_SIZE = 20000
 
 SIM_DATA_DIR = './sim_data'
+SIM_TREE_DIR = None  # opt-in warm start cache of first step trees, e.g. './sim_trees', never cleaned
 MODEL_DATA_DIR = './model_data'
+MARKET_PANEL_DIR = './market_panel'  # memory-mapped data of all stocks, see pipeline/build_panel
 
 SIM_ROUNDS = 1000  # total sample size: SIM_ROUNDS * EPISODE_LENGTH
 SIM_BATCH_SIZE = 100
 SIM_ROUNDS_PER_STEP = 23
+SIM_LEAF_BATCH_SIZE = 8  # leaves evaluated together in one model call
+SIM_MAX_TREE_NODES = 100000  # node budget of one search tree
+SIM_ENDGAME_LEVELS = 10  # last levels solved exactly instead of simulated
+SIM_EARLY_STOP = True  # stop step search once best action can not change
+SIM_PRECOMPUTE_EVALS = True  # one model call for all steps of an episode
+SIM_ROOT_SEARCH = 'puct'  # 'puct' or 'gumbel', gumbel needs fewer simulations, ignores early stop
+SIM_SEARCH_HORIZON = None  # max simulation depth, deeper values from value head
 
 IMPROVE_STEPS_PER_EPOCH = 100
 IMPROVE_BATCH_SIZE = 2048
@@ -1,11 +1,13 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import time
 import unittest
 import mock
 import logging
 
 from common.sim_dataset import SimDataSet
+from common.utils import RateLimiter, jittered_backoff
 
 logger = logging.getLogger(__name__)
 
@@ -85,6 +87,21 @@ class SimDataSetTestCase(unittest.TestCase):
 
 
 
+class RateLimiterTestCase(unittest.TestCase):
+    def test_rate(self):
+        limiter = RateLimiter(rate=100.0, burst=5)
+        start = time.time()
+        waits = [limiter.acquire() for _ in range(25)]
+        # burst is free, then one acquire every 10ms
+        self.assertEqual(waits[:5], [0.0] * 5)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+    def test_backoff(self):
+        for attempt in range(10):
+            delay = jittered_backoff(attempt, base=1.0, cap=8.0)
+            self.assertTrue(0 <= delay <= min(8.0, 2 ** attempt))
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     unittest.main()
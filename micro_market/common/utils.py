@@ -2,9 +2,12 @@
 from __future__ import unicode_literals
 
 import os
+import time
+import random
 import pstats
 import StringIO
 import logging
+import threading
 
 from common import settings
 from common.filelock import FileLock
@@ -33,6 +36,35 @@ def get_dir_list(file_dir):
     return file_paths
 
 
+def jittered_backoff(attempt, base=1.0, cap=60.0):
+    """seconds to wait before retry `attempt` (from 0), exponential with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """token bucket shared by threads, `rate` acquires per second with bursts of `burst`"""
+
+    def __init__(self, rate, burst=1):
+        assert(rate > 0 and burst >= 1)
+        self._rate = float(rate)
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            # reserve a token, callers after an empty bucket wait in turn
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
 class Profiling(object):
     def __init__(self, pr):
         self._pr = pr
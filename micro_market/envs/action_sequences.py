@@ -0,0 +1,45 @@
+# coding: utf-8
+import numpy as np
+
+
+def sequence_navs(pct_change, actions, idx):
+    """
+        nav paths of action sequences, same as navs recorded by FastTradingEnv.step
+        Args:
+            pct_change (array): close pct change + 1.0 of stock
+            actions (array): action sequences (M, days) of 0/1, each starts at data step 0
+            idx (int or array): episode start idx, one for all or one per sequence (M,)
+        Returns:
+            array: navs (M, days), nav after every step
+    """
+    actions = np.asarray(actions)
+    idx = np.broadcast_to(np.asarray(idx, dtype=np.int64), actions.shape[:1])
+    # nav of step t is multiplied by pct change of data step t + 1 when holding
+    nav_pct_change = pct_change[idx[:, None] + np.arange(1, actions.shape[1] + 1)[None, :]]
+    # cumprod multiplies in the same order as step by step, so navs are exactly the same
+    return np.cumprod(np.where(actions == 1, nav_pct_change, 1.0), axis=1)
+
+
+def sequence_rewards(actions, navs, trading_cost_pct_change):
+    """rewards (M, days) of every step, same as FastTradingEnv.step"""
+    actions = np.asarray(actions)
+    changed = np.zeros(actions.shape, dtype=bool)
+    changed[:, 1:] = actions[:, 1:] != actions[:, :-1]
+    # episode finished, force sold
+    changed[:, -1] = True
+    return np.where(changed, navs * trading_cost_pct_change - 1.0, 0.0)
+
+
+def evaluate_sequences(pct_change, actions, idx, trading_cost_pct_change):
+    """
+        evaluate whole episodes of many action sequences at once without stepping env
+        Returns:
+            tuple: (final rewards (M,), navs (M, days), trade counts (M,)),
+                trade count is number of position changes charged with trading fee
+    """
+    actions = np.asarray(actions)
+    assert actions.ndim == 2 and np.all((actions == 0) | (actions == 1)), 'invalid actions'
+    navs = sequence_navs(pct_change, actions, idx)
+    final_rewards = navs[:, -1] * trading_cost_pct_change - 1.0
+    trades = (actions[:, 1:] != actions[:, :-1]).sum(axis=1)
+    return final_rewards, navs, trades
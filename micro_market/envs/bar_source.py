@@ -0,0 +1,151 @@
+# coding: utf-8
+import abc
+import logging
+from StringIO import StringIO
+from datetime import datetime, date
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_START = datetime(2016, 8, 29)
+
+
+class TransientSourceError(Exception):
+    """error of source without HTTP response which may succeed on retry"""
+    pass
+
+
+class BarSource(object):
+    """source of daily bars, frames have the same columns as MarketStore.load"""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def fetch(self, name, start, end):
+        """bars of symbol `name` from `start` to `end` datetime (both included) as data frame"""
+        raise NotImplemented
+
+
+def pooled_session(pool_size=10):
+    """requests session which keeps at most `pool_size` connections of each host"""
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class YahooBarSource(BarSource):
+    def __init__(self, session=None):
+        self.session = session
+
+    def fetch(self, name, start, end):
+        import pandas_datareader.data as web
+        from pandas_datareader._utils import RemoteDataError
+        try:
+            return web.DataReader(name, 'yahoo', start=start, end=end, session=self.session)
+        except RemoteDataError as e:
+            # raised for every non-200 response without status code, 429 and 5xx included
+            raise TransientSourceError('fetch {name} error: {e}'.format(name=name, e=e))
+
+
+class HttpBarSource(BarSource):
+    """
+        bars as csv with Date/Open/High/Low/Close/Adj Close/Volume columns,
+        url is `url_template` formatted with name, start and end (YYYY-MM-DD)
+    """
+
+    def __init__(self, url_template, session=None, timeout=30):
+        self.url_template = url_template
+        self.session = session or pooled_session()
+        self.timeout = timeout
+
+    def fetch(self, name, start, end):
+        url = self.url_template.format(
+            name=name, start=start.strftime('%Y-%m-%d'), end=end.strftime('%Y-%m-%d')
+        )
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return pd.read_csv(StringIO(response.content), index_col=0, parse_dates=True)
+
+
+def _to_datetime(day):
+    return datetime.strptime(day, '%Y-%m-%d')
+
+
+def _flush(store, writes, appends):
+    if writes:
+        store.write_many(writes)
+    if appends:
+        store.append_many(appends)
+
+
+def _refresh_symbol(store, source, name, info, start, end_time, stats):
+    """fetch new bars of one symbol, returns (replace all bars, data frame to store)"""
+    if info is None or not info['rows']:
+        df = source.fetch(name, start, end_time)
+        stats['fetched_rows'] += df.shape[0]
+        stats['full_fetches'] += 1
+        stats['new_rows'] += df.shape[0]
+        return True, df
+    last_day = pd.Timestamp(info['end'])
+    df = source.fetch(name, _to_datetime(info['end']), end_time).sort_index()
+    stats['fetched_rows'] += df.shape[0]
+    new_df = df[df.index > last_day]
+    overlap = df[df.index == last_day]
+    stats['new_rows'] += new_df.shape[0]
+    if not overlap.shape[0]:
+        return False, new_df
+    stored = store.load(name)
+    old_bar, bar = stored.iloc[-1], overlap.iloc[-1]
+    if not np.isclose(old_bar['Close'], bar['Close']):
+        # history changed at source, fetch it all again
+        df = source.fetch(name, _to_datetime(info['start']), end_time)
+        stats['fetched_rows'] += df.shape[0]
+        stats['full_fetches'] += 1
+        return True, df
+    if 'Adj Close' in bar and np.isfinite(old_bar['Adj Close']) and \
+            not np.isclose(old_bar['Adj Close'], bar['Adj Close']):
+        # adjustment is a factor of all history before new dividend
+        stored['Adj Close'] *= bar['Adj Close'] / old_bar['Adj Close']
+        stats['rescaled'] += 1
+        return True, pd.concat([stored, new_df.reindex(columns=stored.columns)])
+    return False, new_df
+
+
+def refresh_bars(store, source, names, end=None, start=DEFAULT_START, batch_size=100):
+    """
+        fetch bars after the last stored bar of every symbol and append them to store,
+        symbols not in store are fetched from `start`. the last stored bar is fetched again
+        to check it: adjusted close history is rescaled when the source has re-adjusted it
+        (e.g. after a dividend), history is fetched again when raw close has changed.
+        `updated` of catalog is the high-water mark, symbols updated on `end` are skipped
+        Returns:
+            dict: counts of refreshed symbols, fetched rows, new rows,
+                rescaled and fully fetched symbols
+    """
+    end = pd.Timestamp(end or date.today()).date()
+    end_time = datetime(end.year, end.month, end.day)
+    stats = dict(symbols=0, fetched_rows=0, new_rows=0, rescaled=0, full_fetches=0)
+    writes, appends = [], []
+    for name in names:
+        info = store.info(name)
+        if info is not None and info['updated'] >= str(end):
+            continue
+        stats['symbols'] += 1
+        try:
+            replace, df = _refresh_symbol(store, source, name, info, start, end_time, stats)
+        except Exception as e:
+            logger.exception('refresh stock[{name}] error, {e}'.format(name=name, e=e))
+            continue
+        (writes if replace else appends).append((name, df, end))
+        if len(writes) + len(appends) >= batch_size:
+            _flush(store, writes, appends)
+            writes, appends = [], []
+    _flush(store, writes, appends)
+    logger.info('refreshed bars: {s}'.format(s=stats))
+    return stats
@@ -0,0 +1,157 @@
+# coding: utf-8
+import logging
+import numpy as np
+
+from fast_trading_env import FastTradingEnv
+
+logger = logging.getLogger(__name__)
+
+
+class BatchTradingEnv(object):
+    """
+        `batch_size` episodes of one or more stocks stepped at once,
+        every episode follows the same rules as FastTradingEnv
+        data of all stocks is concatenated, episode i starts at `offsets[stocks[i]] + idx[i]`
+    """
+
+    def __init__(
+        self, names, days, batch_size, use_adjust_close=True, trading_cost_bps=1e-3, panel=None,
+        features=None, feature_cache=None, window=None,
+    ):
+        """
+            Args:
+                window (int): obs rows, see FastTradingEnv
+        """
+        assert(names and batch_size > 0)
+        self.names = list(names)
+        self.days = days
+        self.window = window or days
+        assert(self.window <= days)
+        self.batch_size = batch_size
+
+        envs = [
+            FastTradingEnv(
+                name=name, days=days, use_adjust_close=use_adjust_close,
+                trading_cost_bps=trading_cost_bps, panel=panel, features=features,
+                feature_cache=feature_cache,
+            ) for name in self.names
+        ]
+        lengths = np.array([env.data.shape[0] for env in envs])
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        self.highs = lengths - days  # exclusive upper bound of start idx, as FastTradingEnv
+        self.data = np.concatenate([env.data for env in envs])
+        self.pct_change = np.concatenate([env.pct_change for env in envs])
+        self.trading_cost_pct_change = 1.0 - trading_cost_bps
+
+        # episodes are spread over stocks round robin
+        self.stocks = np.arange(batch_size) % len(self.names)
+        self.idx = np.zeros(batch_size, dtype=np.int64)
+        self.step_count = np.zeros(batch_size, dtype=np.int64)
+        self.actions = np.zeros((batch_size, days))
+        self.navs = np.ones((batch_size, days))
+        # obs of current steps, only the new data row is written in every step
+        # (trailing window obs are gathered in every step instead)
+        self._obs = np.zeros((batch_size, days, self.data.shape[1]))
+        self._rows = np.arange(batch_size)
+        self._days = np.arange(days)
+        self._window_rows = np.arange(-self.window, 0)
+
+        self.reset()
+
+    def action_options(self):
+        return [0, 1]
+
+    @property
+    def dones(self):
+        return self.step_count >= self.days
+
+    @property
+    def trailing_window(self):
+        return self.window < self.days
+
+    def reset(self, mask=None):
+        """reset all episodes, or episodes selected by bool `mask`"""
+        rows = self._rows if mask is None else self._rows[mask]
+        highs = self.highs[self.stocks[rows]]
+        low = max(1, self.window) if self.trailing_window else 1
+        if np.any(highs <= low):
+            raise Exception('stock data too short')
+        self.idx[rows] = np.floor(np.random.uniform(low, highs)).astype(np.int64)
+        self.step_count[rows] = 0
+        self.actions[rows] = 0
+        self.navs[rows] = 1
+        self._obs[rows] = 0.0
+
+    def observations(self, data_steps=None):
+        """
+            obs of all episodes (batch_size, window, features), same as FastTradingEnv.observations
+        """
+        if data_steps is None:
+            data_steps = self.step_count
+        start = self.offsets[self.stocks] + self.idx
+        if self.trailing_window:
+            return self.data[(start + data_steps)[:, None] + self._window_rows]
+        obs = self.data[start[:, None] + self._days]
+        obs[self._days[None, :] >= data_steps[:, None]] = 0.0
+        return obs
+
+    def step(self, actions):
+        """
+            Args:
+                actions (array): action of every episode, ignored for done episodes
+            Returns:
+                tuple: (obs, rewards, dones, navs), done episodes are not stepped and get 0 reward
+                    obs buffer of episode window is updated in place by next step, copy it to keep
+        """
+        actions = np.asarray(actions).reshape(self.batch_size)
+        assert np.all((actions == 0) | (actions == 1)), 'invalid actions'
+        active = ~self.dones
+        rows = self._rows[active]
+        steps = self.step_count[active]
+        actions = actions[active]
+        next_steps = steps + 1
+        nav_pct_change = self.pct_change[self.offsets[self.stocks[rows]] + self.idx[rows] + next_steps]
+
+        first = steps == 0
+        last_navs = np.where(first, 1.0, self.navs[rows, np.maximum(steps - 1, 0)])
+        navs = last_navs * np.where(actions == 1, nav_pct_change, 1.0)
+        self.actions[rows, steps] = actions
+        self.navs[rows, steps] = navs
+
+        # trading fee for changing trade position, and force sold when episode finished
+        changed = ~first & (self.actions[rows, np.maximum(steps - 1, 0)] != actions)
+        done = next_steps >= self.days
+        rewards = np.zeros(self.batch_size)
+        rewards[rows] = np.where(changed | done, navs * self.trading_cost_pct_change - 1.0, 0.0)
+
+        self.step_count[rows] = next_steps
+        if self.trailing_window:
+            obs = self.observations()
+        else:
+            self._obs[rows, steps] = \
+                self.data[self.offsets[self.stocks[rows]] + self.idx[rows] + steps]
+            obs = self._obs
+        all_navs = self.navs[self._rows, np.maximum(self.step_count - 1, 0)]
+        return obs, rewards, self.dones.copy(), all_navs
+
+    def snapshot(self, i):
+        """snapshot of episode `i`, compatible with FastTradingEnv.recover"""
+        return {
+            'idx': int(self.idx[i]),
+            'name': self.names[self.stocks[i]],
+            'days': self.days,
+            'step': int(self.step_count[i]),
+            'actions': self.actions[i].copy(),
+            'navs': self.navs[i].copy(),
+        }
+
+    def recover(self, i, snapshot):
+        """recover episode `i` from FastTradingEnv snapshot"""
+        assert(snapshot['days'] == self.days)
+        self.stocks[i] = self.names.index(snapshot['name'])
+        self.idx[i] = snapshot['idx']
+        self.step_count[i] = snapshot['step']
+        self.actions[i] = snapshot['actions']
+        self.navs[i] = snapshot['navs']
+        if not self.trailing_window:
+            self._obs[i] = self.observations()[i]
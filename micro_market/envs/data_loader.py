@@ -1,19 +1,26 @@
 # coding: utf-8
 import os
+import time
 import logging
 from datetime import datetime, date
 import pandas as pd
-import pandas_datareader.data as web
 import tushare as ts
 
+from common.utils import jittered_backoff
+from market_store import MarketStore
+from bar_source import DEFAULT_START, YahooBarSource
+
 logger = logging.getLogger(__name__)
 
+STORE_DIR = './market_data/'
+
 
 def cached_filename(name, date):
+    # file name of old pickle cache, see market_store.migrate_pickle_cache
     return '{name}_{d}_data.pkl.gz'.format(name=name, d=date)
 
 
-def get_all_hist_data(code, stock_basics, year_interval=3):
+def get_all_hist_data(code, stock_basics, year_interval=3, max_retries=5):
     def format_date(d):
         return d.strftime('%Y-%m-%d')
 
@@ -25,13 +32,23 @@ def get_all_hist_data(code, stock_basics, year_interval=3):
     start_date = ipo_date
     end_date = date(start_date.year+year_interval, 1, 1)
     data_frames = []
+    attempt = 0
     while now_date >= start_date:
         try:
             batch_df = ts.get_h_data(
                 code, start=format_date(start_date), end=format_date(end_date), proxies=proxies
             )
-        except:
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            delay = jittered_backoff(attempt)
+            logger.warning('get {code} data error, retry in {d:.2f}s: {e}'.format(
+                code=code, d=delay, e=e
+            ))
+            time.sleep(delay)
+            attempt += 1
             continue
+        attempt = 0
         data_frames.append(batch_df)
         start_date = end_date
         end_date = date(start_date.year+year_interval, 1, 1)
@@ -43,30 +60,31 @@ def get_data_tushare(code):
     return get_all_hist_data(code, stock_basics)
 
 
-def data_loader(name, start=None, compression='gzip'):
-    if not start:
-        start = datetime(2016, 8, 29)
-    df = None
-    cache_dir = './tmp_data/'
-    if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
-        logger.info('tmp data dir: {p} created'.format(p=cache_dir))
-
-    files = os.listdir(cache_dir)
-    for f in files:
-        if name in f:
-            # found cache file
-            data_path = os.path.join(cache_dir, f)
-            df = pd.read_pickle(data_path, compression=compression)
-            break
+def data_loader(name, start=None, store_dir=STORE_DIR, source=None):
+    """
+        daily bars of stock `name`, downloaded once into local MarketStore,
+        see bar_source.refresh_bars for updating stored bars
+    """
+    store = MarketStore.open(store_dir)
+    df = store.load(name)
     if df is None or df.empty:
         # download from web
-        df = web.DataReader(name, 'yahoo', start=start, end=datetime.now())
+        source = source or YahooBarSource()
+        df = source.fetch(name, start or DEFAULT_START, datetime.now())
         # df = get_data_tushare(name)
         # cache data
-        now_date = datetime.now().date()
-        df.to_pickle(
-            os.path.join(cache_dir, cached_filename(name, now_date)),
-            compression=compression
-        )
+        store.write(name, df)
     return df
+
+
+def data_version(name, store_dir=STORE_DIR):
+    """
+        stamp of stored bars of stock `name`, changed by every write or refresh of them,
+        None if stock is not in store
+    """
+    if not os.path.exists(store_dir):
+        return None
+    info = MarketStore.open(store_dir).info(name)
+    if info is None:
+        return None
+    return '{e}_{r}_{u}'.format(e=info['end'], r=info['rows'], u=info['updated'])
@@ -2,35 +2,56 @@
 import logging
 import numpy as np
 
-from data_loader import data_loader
+import features as feature_lib
+from action_sequences import evaluate_sequences
 
 logger = logging.getLogger(__name__)
 
 
 class FastTradingEnv(object):
 
-    VOLUME_SCALE_FACTOR = 1000000.0
-
-    def __init__(self, name, days, use_adjust_close=True, trading_cost_bps=1e-3):
+    VOLUME_SCALE_FACTOR = feature_lib.VOLUME_SCALE_FACTOR
+
+    def __init__(
+        self, name, days, use_adjust_close=True, trading_cost_bps=1e-3, panel=None,
+        features=None, feature_cache=None, window=None,
+    ):
+        """
+            Args:
+                days (int): episode length
+                window (int): obs rows, default `days`. obs of a shorter window is the trailing
+                    `window` data rows before current step, so obs size does not grow with `days`,
+                    obs of `days` rows is the episode window padded with zeros after current step
+                panel (MarketPanel): attach to data of prebuilt market panel without copy,
+                    stock data is loaded as usual if it is not in panel
+                features (tuple): obs feature names, see envs.features, default BASE_FEATURES
+                feature_cache (FeatureCache): load computed features from disk cache
+                    on miss of process stock data cache
+        """
         self.name = name
         self.days = days
-
-        data_df = data_loader(self.name)
-        if data_df.empty:
-            raise Exception('load stock[{name}] data error'.format(name=self.name))
-        logger.debug('stock[{name}] data loaded'.format(name=self.name))
-
-        close_column = 'Adj Close' if use_adjust_close else 'Close'
-        data_df = data_df[['Open', 'High', 'Low', close_column, 'Volume']]
-        data_df.columns = ['open', 'high', 'low', 'close', 'volume']
-        data_df = data_df[(~np.isnan(data_df.volume)) & (data_df.volume > 1e-9)]  # 跳过所有停牌日
-        self.pct_change = data_df.pct_change().fillna(0.0) + 1.0  # 计算变化量
-        data_df.volume = data_df.volume / FastTradingEnv.VOLUME_SCALE_FACTOR
-        self.data = data_df.as_matrix()
+        self.window = window or days
+        assert(self.window <= days)
+        self.panel = panel
+        self.features = tuple(features or feature_lib.BASE_FEATURES)
+        self.feature_cache = feature_cache
+
+        if panel is not None and panel.has_stock(name, use_adjust_close, self.features):
+            self.data, self.pct_change = panel.stock(name)
+        else:
+            # envs of the same stock share loaded data, see features.StockDataCache
+            self.data, self.pct_change = feature_lib.stock_data_cache.load(
+                name, use_adjust_close=use_adjust_close, features=self.features,
+                feature_cache=feature_cache,
+            )
 
         self.trading_cost_pct_change = 1.0 - trading_cost_bps
         self._actions = np.zeros(self.days)
         self._navs = np.ones(self.days)
+        self._episode_id = 0  # changed on every reset/recover, see `checkpoint`
+        # obs of all data steps of one window, see `_obs_windows`
+        self._windows = None
+        self._windows_idx = None
 
         self.reset()
 
@@ -41,25 +62,37 @@ class FastTradingEnv(object):
     def action_options(self):
         return [0, 1]
 
+    @property
+    def trailing_window(self):
+        """obs is trailing window of data before current step, see `observations`"""
+        return self.window < self.days
+
     def reset(self):
         # we want continuous data
+        low = max(1, self.window) if self.trailing_window else 1
         high = self.data.shape[0] - self.days
-        if high <= 1:
+        if high <= low:
             raise Exception('stock[{name}] data too short'.format(name=self.name))
-        self._idx = np.random.randint(low=1, high=high)
+        self._idx = np.random.randint(low=low, high=high)
         self._step = 0
+        self._episode_id += 1
         self._actions.fill(0)
         self._navs.fill(1)
 
-    def step(self, action):
+    def step(self, action, with_obs=True):
+        """
+            Args:
+                with_obs (bool): False to skip obs (returned as None), get it later by
+                    `observations(step)` if needed
+        """
         assert action in self.action_space, "%r (%s) invalid" % (action, type(action))
         # data step
         ###############################
         _next_step = self._step + 1
         # get next obs
-        obs = self.observations(_next_step)
+        obs = self.observations(_next_step) if with_obs else None
         # close pct change
-        nav_pct_change = self.pct_change.iat[self._idx + _next_step, 3]
+        nav_pct_change = self.pct_change[self._idx + _next_step]
         done = bool(_next_step >= self.days)
 
         # sim step
@@ -88,14 +121,63 @@ class FastTradingEnv(object):
         self._step += 1
         return obs, reward, done, info
 
-    def observations(self, data_step=0):
-        """get current observations"""
-        current_idx = self._idx + data_step
-        obs = np.zeros((self.days, self.data.shape[1]))
-        if data_step > 0:
-            current_data = self.data[self._idx:current_idx, :]
-            obs[:current_data.shape[0]] += current_data
-        return obs
+    def position_nav(self):
+        """current trade position and nav"""
+        if self._step == 0:
+            return 0, 1.0
+        return int(self._actions[self._step-1]), self._navs[self._step-1]
+
+    def future_pct_changes(self):
+        """close pct change of all remaining steps in current episode"""
+        return self.pct_change[self._idx + self._step + 1:self._idx + self.days + 1]
+
+    def evaluate_sequences(self, actions, idx=None):
+        """
+            evaluate action sequences (M, days) of whole episodes in closed form,
+            episodes start at `idx` (int or array of M), default current episode,
+            see envs.action_sequences.evaluate_sequences
+        """
+        if idx is None:
+            idx = self._idx
+        return evaluate_sequences(self.pct_change, actions, idx, self.trading_cost_pct_change)
+
+    def state_ref(self):
+        """compact reference of current observations, see `observations`"""
+        return self._idx, self._step
+
+    def state_key(self, nav_decimals=4):
+        """
+            canonical key of current state, future of episode only depends on
+            (idx, step, current position, nav), nav is rounded to `nav_decimals`
+        """
+        position, nav = self.position_nav()
+        return (self._idx, self._step, position, round(nav, nav_decimals))
+
+    def _obs_windows(self, idx):
+        """
+            obs of every data step of the window starting at `idx` (days + 1, days, features),
+            built once per window, so obs of a step is a read-only view without copy
+        """
+        if self._windows_idx != idx:
+            window = self.data[idx:idx + self.days]
+            mask = np.arange(self.days)[None, :] < np.arange(self.days + 1)[:, None]
+            self._windows = np.where(mask[:, :, None], window[None], 0.0)
+            self._windows.flags.writeable = False
+            self._windows_idx = idx
+        return self._windows
+
+    def observations(self, data_step=0, idx=None):
+        """
+            get current observations, or observations of state reference (idx, data_step)
+            returned obs is a read-only view, copy it before changing
+        """
+        if idx is None:
+            idx = self._idx
+        if self.trailing_window:
+            obs = self.data[idx + data_step - self.window:idx + data_step]
+            obs.flags.writeable = False
+            return obs
+        return self._obs_windows(idx)[data_step]
 
     def snapshot(self):
         return {
@@ -103,8 +185,8 @@ class FastTradingEnv(object):
             'name': self.name,
             'days': self.days,
             'step': self._step,
-            'actions': self._actions,
-            'navs': self._navs,
+            'actions': self._actions.copy(),
+            'navs': self._navs.copy(),
         }
 
     def recover(self, snapshot, copy=True):
@@ -113,5 +195,29 @@ class FastTradingEnv(object):
         self.name = snapshot['name']
         self.days = snapshot['days']
         self._step = snapshot['step']
-        self._actions = np.array(snapshot['actions'], copy=True) if copy else snapshot['actions']
-        self._navs = np.array(snapshot['navs'], copy=True) if copy else snapshot['navs']
+        self._episode_id += 1
+        if not copy:
+            self._actions, self._navs = snapshot['actions'], snapshot['navs']
+        elif self._actions.shape == snapshot['actions'].shape:
+            # copy into exist buffers
+            self._actions[:] = snapshot['actions']
+            self._navs[:] = snapshot['navs']
+        else:
+            self._actions = np.array(snapshot['actions'], copy=True)
+            self._navs = np.array(snapshot['navs'], copy=True)
+
+    def checkpoint(self):
+        """cheap checkpoint of current episode state, see `rewind`"""
+        return self._episode_id, self._step
+
+    def rewind(self, checkpoint):
+        """
+            rewind env to `checkpoint` of the same episode in O(1) without copy.
+            `step` only writes `_actions`/`_navs` at current step and reads the step before,
+            so entries before checkpoint step are never changed after checkpoint and
+            restoring the step counter is enough
+        """
+        episode_id, step = checkpoint
+        assert episode_id == self._episode_id, 'checkpoint of another episode'
+        assert step <= self._step, 'can not rewind forward'
+        self._step = step
@@ -0,0 +1,195 @@
+# coding: utf-8
+import os
+import json
+import errno
+import hashlib
+import logging
+from collections import OrderedDict
+import numpy as np
+
+from data_loader import data_loader, data_version
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1  # change when any feature formula changes
+VOLUME_SCALE_FACTOR = 1000000.0
+BASE_FEATURES = ('open', 'high', 'low', 'close', 'volume')
+
+
+def _rolling(series, window=30):
+    return series.rolling(window=window, min_periods=1, center=False)
+
+
+# feature name -> function of stock frame (open/high/low/close/volume)
+FEATURES = {
+    'open': lambda df: df.open,
+    'high': lambda df: df.high,
+    'low': lambda df: df.low,
+    'close': lambda df: df.close,
+    'volume': lambda df: df.volume,
+    # prices relative to close
+    'norm_open': lambda df: df.open / df.close - 1.0,
+    'norm_high': lambda df: df.high / df.close - 1.0,
+    'norm_low': lambda df: df.low / df.close - 1.0,
+    'log_return': lambda df: np.log(df.close / df.close.shift(1)).fillna(0.0),
+    'close_ma_ratio_30': lambda df: df.close / _rolling(df.close).mean() - 1.0,
+    # volume statistics, refer to: demo/volume_detector.ipynb
+    'volume_avg_30': lambda df: _rolling(df.volume).mean(),
+    'volume_std_30': lambda df: _rolling(df.volume).std().fillna(0.0),
+    'volume_zscore_30': lambda df: (
+        (df.volume - _rolling(df.volume).mean()) /
+        _rolling(df.volume).std().replace(0.0, np.nan)
+    ).fillna(0.0),
+    'volume_signal': lambda df: (
+        (df.volume > _rolling(df.volume).mean() + _rolling(df.volume).std().fillna(0.0) * 2) &
+        (df.close > df.open)
+    ).astype(np.float64),
+}
+
+
+def feature_key(features):
+    """version hash of feature set, cached arrays of another key are never reused"""
+    return hashlib.sha1(json.dumps([VERSION, list(features)])).hexdigest()[:12]
+
+
+def load_stock_frame(name, use_adjust_close=True):
+    """stock data frame with open/high/low/close/volume columns, suspended days skipped"""
+    data_df = data_loader(name)
+    if data_df.empty:
+        raise Exception('load stock[{name}] data error'.format(name=name))
+    logger.debug('stock[{name}] data loaded'.format(name=name))
+
+    close_column = 'Adj Close' if use_adjust_close else 'Close'
+    data_df = data_df[['Open', 'High', 'Low', close_column, 'Volume']]
+    data_df.columns = ['open', 'high', 'low', 'close', 'volume']
+    data_df = data_df[(~np.isnan(data_df.volume)) & (data_df.volume > 1e-9)]  # 跳过所有停牌日
+    data_df.volume = data_df.volume / VOLUME_SCALE_FACTOR
+    return data_df
+
+
+def load_stock_data(name, use_adjust_close=True, features=None):
+    """
+        load stock data as env input
+        Returns:
+            tuple: (contiguous array of `features` (day, feature), close pct change + 1.0)
+    """
+    data_df = load_stock_frame(name, use_adjust_close=use_adjust_close)
+    pct_change = (data_df.close.pct_change().fillna(0.0) + 1.0).values  # 计算变化量
+    data = np.empty((data_df.shape[0], len(features or BASE_FEATURES)), dtype=np.float64)
+    for i, feature in enumerate(features or BASE_FEATURES):
+        data[:, i] = FEATURES[feature](data_df)
+    return data, pct_change
+
+
+class FeatureCache(object):
+    """
+        on-disk cache of `load_stock_data` results as .npy files,
+        grouped by feature set key, files are memory-mapped on load.
+        files are named by data version of stock, so refreshed bars are computed again
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _dir(self, features):
+        return os.path.join(self.cache_dir, feature_key(features or BASE_FEATURES))
+
+    def _path(self, name, use_adjust_close, features, version, kind):
+        return os.path.join(
+            self._dir(features),
+            '{n}.{v}.{c}.{k}.npy'.format(
+                n=name, v=version, c='adj' if use_adjust_close else 'raw', k=kind
+            )
+        )
+
+    def _remove_stale(self, name, use_adjust_close, features, version):
+        """remove files of other data versions of stock"""
+        cache_dir = self._dir(features)
+        for f in os.listdir(cache_dir):
+            if not f.startswith(name + '.'):
+                continue
+            parts = f[len(name) + 1:].split('.')
+            # parts of another stock whose name starts with `name.` have more dots
+            if len(parts) == 4 and parts[0] != version and \
+                    parts[1] == ('adj' if use_adjust_close else 'raw'):
+                try:
+                    os.remove(os.path.join(cache_dir, f))
+                except OSError:
+                    pass  # removed by another process
+
+    def load(self, name, use_adjust_close=True, features=None):
+        """(data, pct_change) of stock, computed and saved on first load of every data version"""
+        version = data_version(name) or 'na'
+        pct_change_path = self._path(name, use_adjust_close, features, version, 'pct_change')
+        if not os.path.exists(pct_change_path):
+            data, pct_change = load_stock_data(
+                name, use_adjust_close=use_adjust_close, features=features
+            )
+            # bars of stock not in store are stored by first load
+            version = data_version(name) or 'na'
+            pct_change_path = self._path(name, use_adjust_close, features, version, 'pct_change')
+            try:
+                os.makedirs(self._dir(features))
+            except OSError as e:
+                # created by another worker
+                if e.errno != errno.EEXIST:
+                    raise
+            self._remove_stale(name, use_adjust_close, features, version)
+            data_path = self._path(name, use_adjust_close, features, version, 'data')
+            # pct_change is written last, its existence marks a complete entry
+            for path, arr in ((data_path, data), (pct_change_path, pct_change)):
+                # temp file of this process, workers computing the same stock do not mix up
+                tmp_path = '{p}.{pid}.tmp'.format(p=path, pid=os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, arr)
+                os.rename(tmp_path, path)
+        data_path = self._path(name, use_adjust_close, features, version, 'data')
+        return np.load(data_path, mmap_mode='r'), np.load(pct_change_path, mmap_mode='r')
+
+
+class StockDataCache(object):
+    """
+        process-local LRU cache of processed (data, pct_change) of stocks, shared by all envs,
+        keyed by (name, data version, use_adjust_close, features), cached arrays are read-only
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, name, use_adjust_close=True, features=None, feature_cache=None):
+        """(data, pct_change) of stock, loaded by `feature_cache` or `load_stock_data` on miss"""
+        features = tuple(features or BASE_FEATURES)
+        key = (name, data_version(name), use_adjust_close, features)
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.hits += 1
+            self._items[key] = item  # most recently used
+            return item
+        self.misses += 1
+        if feature_cache is not None:
+            item = feature_cache.load(name, use_adjust_close=use_adjust_close, features=features)
+        else:
+            item = load_stock_data(name, use_adjust_close=use_adjust_close, features=features)
+        for arr in item:
+            arr.flags.writeable = False
+        # bars of stock not in store are stored by first load, key by stored version
+        key = (name, data_version(name), use_adjust_close, features)
+        self._items[key] = item
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return item
+
+
+# stock data of this process, inherited by forked worker processes
+stock_data_cache = StockDataCache()
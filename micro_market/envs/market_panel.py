@@ -0,0 +1,124 @@
+# coding: utf-8
+import os
+import json
+import shutil
+import logging
+import numpy as np
+
+from features import BASE_FEATURES, load_stock_data
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+DATA_FILE = 'data.npy'
+PCT_CHANGE_FILE = 'pct_change.npy'
+VERSION = 2
+
+# panel dir -> opened MarketPanel, inherited by forked worker processes
+_opened_panels = dict()
+
+
+def build_panel(names, panel_dir, use_adjust_close=False, features=None, feature_cache=None):
+    """
+        build market panel of stocks `names` in `panel_dir`:
+        data (stock, day, feature) and pct_change (stock, day) arrays as .npy files,
+        rows of every stock start at day 0 and are padded after its length
+        Args:
+            features (tuple): feature names of panel, see envs.features
+            feature_cache (FeatureCache): reuse computed features
+        Returns:
+            list: symbols in panel, stocks failed to load are skipped
+    """
+    features = tuple(features or BASE_FEATURES)
+    symbols, datas, pct_changes = [], [], []
+    for name in names:
+        try:
+            if feature_cache is not None:
+                data, pct_change = feature_cache.load(
+                    name, use_adjust_close=use_adjust_close, features=features
+                )
+            else:
+                data, pct_change = load_stock_data(
+                    name, use_adjust_close=use_adjust_close, features=features
+                )
+        except Exception as e:
+            logger.exception('load stock[{name}] error, {e}'.format(name=name, e=e))
+            continue
+        symbols.append(name)
+        datas.append(data)
+        pct_changes.append(pct_change)
+    assert(symbols)
+    lengths = [data.shape[0] for data in datas]
+    max_length = max(lengths)
+
+    tmp_dir = panel_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    data_panel = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, DATA_FILE), mode='w+', dtype=np.float64,
+        shape=(len(symbols), max_length, datas[0].shape[1]),
+    )
+    pct_change_panel = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, PCT_CHANGE_FILE), mode='w+', dtype=np.float64,
+        shape=(len(symbols), max_length),
+    )
+    for i, (data, pct_change) in enumerate(zip(datas, pct_changes)):
+        data_panel[i, :data.shape[0]] = data
+        data_panel[i, data.shape[0]:] = 0.0
+        pct_change_panel[i, :pct_change.shape[0]] = pct_change
+        pct_change_panel[i, pct_change.shape[0]:] = 1.0
+    data_panel.flush()
+    pct_change_panel.flush()
+    del data_panel, pct_change_panel
+    with open(os.path.join(tmp_dir, INDEX_FILE), 'w') as f:
+        json.dump({
+            'version': VERSION,
+            'symbols': symbols,
+            'lengths': lengths,
+            'use_adjust_close': use_adjust_close,
+            'features': features,
+        }, f)
+    # replace old panel
+    if os.path.exists(panel_dir):
+        shutil.rmtree(panel_dir)
+    os.rename(tmp_dir, panel_dir)
+    logger.info('market panel of {n} stocks built in [{d}]'.format(n=len(symbols), d=panel_dir))
+    return symbols
+
+
+class MarketPanel(object):
+    """read-only memory-mapped market panel, see `build_panel`"""
+
+    def __init__(self, panel_dir):
+        with open(os.path.join(panel_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index['version'] != VERSION:
+            raise ValueError('unsupported market panel version: {v}'.format(v=index['version']))
+        self.panel_dir = panel_dir
+        self.use_adjust_close = index['use_adjust_close']
+        self.features = tuple(index['features'])
+        self.symbols = index['symbols']
+        self.lengths = index['lengths']
+        self._symbol_index = dict([(symbol, i) for i, symbol in enumerate(self.symbols)])
+        self.data = np.load(os.path.join(panel_dir, DATA_FILE), mmap_mode='r')
+        self.pct_change = np.load(os.path.join(panel_dir, PCT_CHANGE_FILE), mmap_mode='r')
+
+    @classmethod
+    def open(cls, panel_dir):
+        """opened panel of this process, None if panel is not built"""
+        if not panel_dir or not os.path.exists(os.path.join(panel_dir, INDEX_FILE)):
+            return None
+        if panel_dir not in _opened_panels:
+            _opened_panels[panel_dir] = cls(panel_dir)
+        return _opened_panels[panel_dir]
+
+    def has_stock(self, name, use_adjust_close, features=BASE_FEATURES):
+        return use_adjust_close == self.use_adjust_close and \
+            tuple(features) == self.features and name in self._symbol_index
+
+    def stock(self, name):
+        """(data, pct_change) views of stock `name` without copy"""
+        i = self._symbol_index[name]
+        length = self.lengths[i]
+        return self.data[i, :length], self.pct_change[i, :length]
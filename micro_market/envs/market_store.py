@@ -0,0 +1,293 @@
+# coding: utf-8
+import os
+import re
+import json
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from common.filelock import FileLock
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE = 'catalog.json'
+VERSION = 2
+# column name -> (frame column, dtype), dates are stored as days since epoch
+COLUMNS = (
+    ('date', None, np.int64),
+    ('open', 'Open', np.float64),
+    ('high', 'High', np.float64),
+    ('low', 'Low', np.float64),
+    ('close', 'Close', np.float64),
+    ('adj_close', 'Adj Close', np.float64),
+    ('volume', 'Volume', np.float64),
+)
+PICKLE_FILE_PATTERN = re.compile(r'^(?P<name>.+)_(?P<date>\d{4}-\d{2}-\d{2})_data\.pkl\.gz$')
+
+# store dir -> opened MarketStore
+_opened_stores = dict()
+
+
+def _format_day(day):
+    return str(np.datetime64(int(day), 'D'))
+
+
+class MarketStore(object):
+    """
+        local store of daily bars of all symbols
+        every column is one append-only raw array file shared by all symbols, `catalog.json`
+        maps symbol to segments of (offset, rows) in date order and keeps date range and
+        update date of every symbol. appending bars of a symbol writes the new rows only as
+        a new segment, replacing a symbol leaves its old rows as garbage until `compact`
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self._catalog_path = os.path.join(store_dir, CATALOG_FILE)
+        self._catalog_version = None  # (inode, mtime) of loaded catalog file
+        self._catalog = {'version': VERSION, 'rows': 0, 'symbols': {}}
+        self._reload()
+
+    @classmethod
+    def open(cls, store_dir):
+        """opened store of this process"""
+        if store_dir not in _opened_stores:
+            _opened_stores[store_dir] = cls(store_dir)
+        return _opened_stores[store_dir]
+
+    def _column_path(self, column):
+        return os.path.join(self.store_dir, '{c}.bin'.format(c=column))
+
+    def _reload(self):
+        """reload catalog if it is changed by another process"""
+        if not os.path.exists(self._catalog_path):
+            return
+        stat = os.stat(self._catalog_path)
+        # catalog is replaced by rename on every write, so inode changes too
+        version = (stat.st_ino, stat.st_mtime)
+        if version == self._catalog_version:
+            return
+        with open(self._catalog_path) as f:
+            catalog = json.load(f)
+        if catalog['version'] == 1:
+            # version 1 kept one contiguous (offset, rows) of every symbol
+            for info in catalog['symbols'].values():
+                info['segments'] = [[info.pop('offset'), info['rows']]]
+            catalog['version'] = VERSION
+        if catalog['version'] != VERSION:
+            raise ValueError('unsupported market store version: {v}'.format(v=catalog['version']))
+        self._catalog = catalog
+        self._catalog_version = version
+
+    def _save_catalog(self):
+        tmp_path = self._catalog_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._catalog, f)
+        os.rename(tmp_path, self._catalog_path)
+        stat = os.stat(self._catalog_path)
+        self._catalog_version = (stat.st_ino, stat.st_mtime)
+
+    @property
+    def symbols(self):
+        self._reload()
+        return sorted(self._catalog['symbols'].keys())
+
+    def info(self, name):
+        """catalog entry of symbol: segments, rows, start, end and updated date, None if missing"""
+        self._reload()
+        return self._catalog['symbols'].get(name)
+
+    def has(self, name):
+        return self.info(name) is not None
+
+    def _read_columns(self, segments):
+        columns = {}
+        for column, _, dtype in COLUMNS:
+            with open(self._column_path(column), 'rb') as f:
+                parts = []
+                for offset, rows in segments:
+                    f.seek(offset * np.dtype(dtype).itemsize)
+                    parts.append(np.fromfile(f, dtype=dtype, count=rows))
+            columns[column] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return columns
+
+    def load(self, name):
+        """
+            daily bars of symbol as data frame indexed by date, columns are
+            Open/High/Low/Close/Adj Close/Volume, None if symbol is not in store
+        """
+        info = self.info(name)
+        if info is None:
+            return None
+        columns = self._read_columns(info['segments'])
+        df = pd.DataFrame(
+            dict([(frame_column, columns[column]) for column, frame_column, _ in COLUMNS[1:]]),
+            index=pd.DatetimeIndex(columns['date'].astype('datetime64[D]'), name='Date'),
+        )
+        return df[[frame_column for _, frame_column, _ in COLUMNS[1:]]]
+
+    @staticmethod
+    def _to_arrays(df):
+        """column arrays of data frame in COLUMNS order, missing columns are NaN"""
+        df = df.sort_index()
+        arrays = [np.asarray(df.index.values.astype('datetime64[D]').astype(np.int64))]
+        for _, frame_column, dtype in COLUMNS[1:]:
+            if frame_column in df.columns:
+                arrays.append(df[frame_column].values.astype(dtype))
+            else:
+                arrays.append(np.full(df.shape[0], np.nan, dtype=dtype))
+        return arrays
+
+    def _write_rows(self, arrays_list):
+        """append column arrays at the end of column files, returns their offsets, under lock"""
+        offset = self._catalog['rows']
+        for i, (column, _, dtype) in enumerate(COLUMNS):
+            with open(self._column_path(column), 'ab') as f:
+                # drop rows of an interrupted write which are not in catalog
+                f.truncate(offset * np.dtype(dtype).itemsize)
+                for arrays in arrays_list:
+                    f.write(np.ascontiguousarray(arrays[i]).tobytes())
+        offsets = []
+        for arrays in arrays_list:
+            offsets.append(offset)
+            offset += arrays[0].shape[0]
+        self._catalog['rows'] = offset
+        return offsets
+
+    def _write_entries(self, entries):
+        """replace symbols by (name, arrays, updated) entries and save catalog, under lock"""
+        offsets = self._write_rows([arrays for _, arrays, _ in entries])
+        for (name, arrays, updated), offset in zip(entries, offsets):
+            rows = arrays[0].shape[0]
+            self._catalog['symbols'][name] = {
+                'segments': [[offset, rows]] if rows else [],
+                'rows': rows,
+                'start': _format_day(arrays[0][0]) if rows else None,
+                'end': _format_day(arrays[0][-1]) if rows else None,
+                'updated': str(updated),
+            }
+        self._save_catalog()
+
+    def write(self, name, df, updated=None):
+        """
+            replace bars of symbol with data frame `df` (see `load` for columns,
+            missing columns are NaN), `updated` is the date data was fetched, default today
+        """
+        self.write_many([(name, df, updated)])
+
+    def write_many(self, items):
+        """write list of (name, df, updated) with one catalog update, see `write`"""
+        entries = [
+            (name, self._to_arrays(df), updated or datetime.now().date())
+            for name, df, updated in items
+        ]
+        with FileLock(file_name=self._catalog_path):
+            self._reload()
+            self._write_entries(entries)
+
+    def append_many(self, items):
+        """
+            append list of (name, df, updated) to exist symbols, bars of `df` must be after
+            `end` of symbol, empty `df` only moves `updated` of symbol forward.
+            only new rows are written, as a new segment of symbol
+        """
+        with FileLock(file_name=self._catalog_path):
+            self._reload()
+            entries = []
+            for name, df, updated in items:
+                info = self._catalog['symbols'][name]
+                info['updated'] = str(updated or datetime.now().date())
+                arrays = self._to_arrays(df)
+                if not arrays[0].shape[0]:
+                    continue
+                assert(not info['rows'] or _format_day(arrays[0][0]) > info['end'])
+                entries.append((info, arrays))
+            offsets = self._write_rows([arrays for _, arrays in entries])
+            for (info, arrays), offset in zip(entries, offsets):
+                rows = arrays[0].shape[0]
+                segments = info['segments']
+                if segments and segments[-1][0] + segments[-1][1] == offset:
+                    # last segment ends at the end of files, extend it
+                    segments[-1][1] += rows
+                else:
+                    segments.append([offset, rows])
+                if not info['rows']:
+                    info['start'] = _format_day(arrays[0][0])
+                info['rows'] += rows
+                info['end'] = _format_day(arrays[0][-1])
+            self._save_catalog()
+
+    def garbage_rows(self):
+        """rows replaced by later writes, reclaimed by `compact`"""
+        self._reload()
+        return self._catalog['rows'] - sum(
+            [info['rows'] for info in self._catalog['symbols'].values()]
+        )
+
+    def compact(self):
+        """
+            rewrite column files with live rows only, segments of every symbol are merged,
+            readers of other processes should be stopped
+        """
+        with FileLock(file_name=self._catalog_path):
+            self._reload()
+            symbols = sorted(
+                self._catalog['symbols'].items(),
+                key=lambda item: item[1]['segments'][0][0] if item[1]['segments'] else -1
+            )
+            for column, _, dtype in COLUMNS:
+                itemsize = np.dtype(dtype).itemsize
+                tmp_path = self._column_path(column) + '.tmp'
+                with open(self._column_path(column), 'rb') as src, open(tmp_path, 'wb') as dst:
+                    for _, info in symbols:
+                        for offset, rows in info['segments']:
+                            src.seek(offset * itemsize)
+                            dst.write(src.read(rows * itemsize))
+            offset = 0
+            for _, info in symbols:
+                info['segments'] = [[offset, info['rows']]] if info['rows'] else []
+                offset += info['rows']
+            # column files and catalog are replaced together under lock
+            for column, _, _ in COLUMNS:
+                os.rename(self._column_path(column) + '.tmp', self._column_path(column))
+            self._catalog['rows'] = offset
+            self._save_catalog()
+
+
+def migrate_pickle_cache(cache_dir, store, batch_size=100):
+    """
+        import `{name}_{date}_data.pkl.gz` files of old data_loader cache into store,
+        the latest file of every symbol is imported with its date as update date,
+        `batch_size` symbols are written with one catalog update
+        Returns:
+            list: imported symbols
+    """
+    latest = {}
+    for f in os.listdir(cache_dir):
+        match = PICKLE_FILE_PATTERN.match(f)
+        if not match:
+            continue
+        name, day = match.group('name'), match.group('date')
+        if name not in latest or latest[name][0] < day:
+            latest[name] = (day, f)
+    imported, items = [], []
+    for name, (day, f) in sorted(latest.items()):
+        try:
+            df = pd.read_pickle(os.path.join(cache_dir, f), compression='gzip')
+        except Exception as e:
+            logger.exception('read cache file[{f}] error, {e}'.format(f=f, e=e))
+            continue
+        if df.empty:
+            continue
+        items.append((name, df, day))
+        imported.append(name)
+        if len(items) >= batch_size:
+            store.write_many(items)
+            items = []
+    if items:
+        store.write_many(items)
+    logger.info('{n} symbols migrated from [{d}]'.format(n=len(imported), d=cache_dir))
+    return imported
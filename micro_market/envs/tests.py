@@ -1,9 +1,24 @@
 # coding: utf-8
+import os
+import shutil
+import datetime
+import tempfile
 import unittest
 import timeit
+import mock
 import numpy as np
 
 from envs.fast_trading_env import FastTradingEnv
+from envs.batch_trading_env import BatchTradingEnv
+from envs.market_panel import MarketPanel, build_panel
+from envs.market_store import MarketStore, migrate_pickle_cache
+from envs.bar_source import BarSource, refresh_bars
+from envs.data_loader import cached_filename, data_loader, data_version
+from envs.action_sequences import sequence_rewards
+from envs.features import (
+    FEATURES, BASE_FEATURES, FeatureCache, StockDataCache, feature_key, load_stock_data,
+    stock_data_cache,
+)
 
 
 class FastTradingEnvTestCase(unittest.TestCase):
@@ -71,6 +86,73 @@ while not done:
         self.assertEqual(count, self.days / 2)
         self.assertEqual(sum_reward, recover_sum_reward)
 
+    def test_checkpoint_rewind(self):
+        self.env.reset()
+        for _ in range(self.days / 2):
+            self.env.step(1)
+        checkpoint = self.env.checkpoint()
+        snapshot = self.env.snapshot()
+        actions = np.random.choice(self.env.action_options(), self.days / 2)
+        rewards = [self.env.step(action)[1] for action in actions]
+        # rewind and replay with other actions, then replay the original ones
+        for _ in range(3):
+            self.env.rewind(checkpoint)
+            for action in 1 - actions:
+                self.env.step(action)
+        self.env.rewind(checkpoint)
+        replay_rewards = [self.env.step(action)[1] for action in actions]
+        self.assertEqual(rewards, replay_rewards)
+        # snapshot is not aliased with live env arrays
+        self.env.rewind(checkpoint)
+        self.env.step(0)
+        self.env.recover(snapshot)
+        self.assertEqual([self.env.step(action)[1] for action in actions], rewards)
+        # checkpoint is invalid after env reset
+        self.env.reset()
+        self.assertRaises(AssertionError, self.env.rewind, checkpoint)
+
+    def test_obs_view(self):
+        self.env.reset()
+        snapshot = self.env.snapshot()
+        windows = []
+        for step in range(1, self.days + 1):
+            obs, reward, done, info = self.env.step(1)
+            expected = np.zeros((self.days, self.env.data.shape[1]))
+            expected[:step] = self.env.data[snapshot['idx']:snapshot['idx'] + step]
+            np.testing.assert_array_equal(obs, expected)
+            # read-only view of the window table, no copy per step
+            self.assertFalse(obs.flags.writeable)
+            windows.append(obs.base)
+        self.assertTrue(all([window is windows[0] for window in windows]))
+        # obs on request only
+        self.env.recover(snapshot)
+        obs, reward, done, info = self.env.step(1, with_obs=False)
+        self.assertIsNone(obs)
+        np.testing.assert_array_equal(self.env.observations(1), windows[0][1])
+
+    def test_trailing_window(self):
+        window = 20
+        env = FastTradingEnv(name='000333.SZ', days=self.days, window=window)
+        self.assertTrue(env.trailing_window)
+        snapshot = env.snapshot()
+        self.assertGreaterEqual(snapshot['idx'], window)
+        obs = env.observations()
+        for step in range(1, self.days + 1):
+            # obs size does not grow with episode
+            self.assertEqual(obs.shape, (window, env.data.shape[1]))
+            np.testing.assert_array_equal(
+                obs, env.data[snapshot['idx'] + step - 1 - window:snapshot['idx'] + step - 1]
+            )
+            self.assertFalse(obs.flags.writeable)
+            obs, reward, done, info = env.step(1)
+        self.assertTrue(done)
+        # same rewards as episode window obs
+        full = FastTradingEnv(name='000333.SZ', days=self.days)
+        full.recover(snapshot)
+        env.recover(snapshot)
+        for _ in range(self.days):
+            self.assertEqual(env.step(1)[1], full.step(1)[1])
+
     def test_buy_hold_to_end(self):
         self.env.reset()
         done = False
@@ -85,5 +167,392 @@ while not done:
                 self.assertGreater(reward, 0.0)
 
 
+class BatchTradingEnvTestCase(unittest.TestCase):
+    def setUp(self):
+        self.days = 30
+        self.names = ['000333.SZ', '600016.SS']
+        self.env = BatchTradingEnv(names=self.names, days=self.days, batch_size=16)
+
+    def test_same_as_fast_env(self):
+        envs = [FastTradingEnv(name=name, days=self.days) for name in self.names]
+        self.env.reset()
+        snapshots = [self.env.snapshot(i) for i in range(self.env.batch_size)]
+        actions = np.random.choice(self.env.action_options(), (self.days, self.env.batch_size))
+        results = []
+        for step_actions in actions:
+            obs, rewards, dones, navs = self.env.step(step_actions)
+            results.append((obs.copy(), rewards, dones, navs))
+        # every episode replayed on FastTradingEnv
+        for i in range(self.env.batch_size):
+            single = envs[self.env.stocks[i]]
+            single.recover(snapshots[i])
+            for step in range(self.days):
+                obs, reward, done, info = single.step(actions[step, i])
+                batch_obs, batch_rewards, batch_dones, batch_navs = results[step]
+                np.testing.assert_array_equal(batch_obs[i], obs)
+                self.assertAlmostEqual(batch_rewards[i], reward)
+                self.assertEqual(batch_dones[i], done)
+                self.assertAlmostEqual(batch_navs[i], info['nav'])
+        # done episodes are not stepped any more
+        obs, rewards, dones, navs = self.env.step(np.ones(self.env.batch_size))
+        self.assertTrue(dones.all())
+        self.assertFalse(rewards.any())
+
+    def test_trailing_window(self):
+        window = 10
+        env = BatchTradingEnv(names=self.names, days=self.days, batch_size=4, window=window)
+        single = FastTradingEnv(name=self.names[0], days=self.days, window=window)
+        single.recover(env.snapshot(0))
+        for _ in range(self.days):
+            obs, rewards, dones, navs = env.step(np.ones(env.batch_size))
+            single_obs, reward, done, info = single.step(1)
+            self.assertEqual(obs.shape[1], window)
+            np.testing.assert_array_equal(obs[0], single_obs)
+            self.assertAlmostEqual(rewards[0], reward)
+
+    def test_reset_mask(self):
+        self.env.reset()
+        self.env.step(np.ones(self.env.batch_size))
+        mask = np.arange(self.env.batch_size) % 2 == 0
+        self.env.reset(mask=mask)
+        self.assertTrue((self.env.step_count[mask] == 0).all())
+        self.assertTrue((self.env.step_count[~mask] == 1).all())
+
+    def test_performance(self):
+        env = BatchTradingEnv(names=self.names, days=200, batch_size=1000)
+        count = 10
+        total = timeit.timeit(
+            lambda: [env.reset(), [env.step(np.random.randint(2, size=1000)) for _ in range(200)]],
+            number=count
+        )
+        print 'avg: {t} seconds per 1000 episodes'.format(t=total/count)
+
+
+class ActionSequencesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.days = 30
+        self.env = FastTradingEnv(name='000333.SZ', days=self.days)
+
+    def test_same_as_step(self):
+        count = 50
+        actions = np.random.randint(2, size=(count, self.days))
+        idx = np.random.randint(1, self.env.data.shape[0] - self.days, size=count)
+        final_rewards, navs, trades = self.env.evaluate_sequences(actions, idx=idx)
+        rewards = sequence_rewards(actions, navs, self.env.trading_cost_pct_change)
+        for i in range(count):
+            self.env.recover({
+                'idx': idx[i], 'name': self.env.name, 'days': self.days, 'step': 0,
+                'actions': np.zeros(self.days), 'navs': np.ones(self.days),
+            })
+            for step in range(self.days):
+                _, reward, _, info = self.env.step(actions[i, step])
+                self.assertEqual(rewards[i, step], reward)
+                self.assertEqual(navs[i, step], info['nav'])
+            self.assertEqual(final_rewards[i], reward)
+            self.assertEqual(trades[i], np.count_nonzero(np.diff(actions[i])))
+
+    def test_performance(self):
+        actions = np.random.randint(2, size=(100000, self.days))
+        total = timeit.timeit(lambda: self.env.evaluate_sequences(actions), number=10)
+        print 'avg: {t} seconds per 100000 sequences'.format(t=total/10)
+
+
+class MarketPanelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.days = 30
+        self.names = ['000333.SZ', '600016.SS']
+        self.panel_dir = tempfile.mkdtemp()
+        build_panel(self.names, self.panel_dir, use_adjust_close=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.panel_dir)
+
+    def test_attach_env(self):
+        panel = MarketPanel.open(self.panel_dir)
+        self.assertTrue(panel is MarketPanel.open(self.panel_dir))
+        self.assertEqual(panel.symbols, self.names)
+        for name in self.names:
+            env = FastTradingEnv(name=name, days=self.days, use_adjust_close=False, panel=panel)
+            loaded_env = FastTradingEnv(name=name, days=self.days, use_adjust_close=False)
+            # zero copy view of memory-mapped panel
+            self.assertTrue(np.may_share_memory(env.data, panel.data))
+            np.testing.assert_array_equal(env.data, loaded_env.data)
+            np.testing.assert_array_equal(env.pct_change, loaded_env.pct_change)
+            env.reset()
+            loaded_env.recover(env.snapshot())
+            for action in np.random.choice(env.action_options(), self.days):
+                self.assertEqual(env.step(action)[1], loaded_env.step(action)[1])
+        # stock out of panel, or of other close type, is loaded as usual
+        env = FastTradingEnv(name=self.names[0], days=self.days, panel=panel)
+        self.assertFalse(np.may_share_memory(env.data, panel.data))
+        self.assertIsNone(MarketPanel.open(None))
+
+
+class MarketStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store = MarketStore(self.store_dir)
+        self.names = ['000333.SZ', '600016.SS']
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_write_load(self):
+        frames = dict([(name, data_loader(name)) for name in self.names])
+        for name in self.names:
+            self.store.write(name, frames[name])
+        # symbol which contains another symbol is not mixed up
+        self.assertIsNone(self.store.load('00333.SZ'))
+        for name in self.names:
+            df = self.store.load(name)
+            np.testing.assert_array_equal(df.values, frames[name][df.columns].values)
+            self.assertTrue((df.index == frames[name].index).all())
+            info = self.store.info(name)
+            self.assertEqual(info['rows'], frames[name].shape[0])
+            self.assertEqual(info['end'], str(frames[name].index[-1].date()))
+        # rewrite replaces old rows, another process sees new catalog
+        self.store.write(self.names[0], frames[self.names[0]][:10], updated='2017-01-01')
+        other = MarketStore(self.store_dir)
+        self.assertEqual(other.load(self.names[0]).shape[0], 10)
+        self.assertEqual(other.info(self.names[0])['updated'], '2017-01-01')
+        self.assertEqual(other.garbage_rows(), frames[self.names[0]].shape[0])
+        other.compact()
+        self.assertEqual(self.store.garbage_rows(), 0)
+        df = self.store.load(self.names[1])
+        np.testing.assert_array_equal(df.values, frames[self.names[1]][df.columns].values)
+
+    def test_append(self):
+        frames = dict([(name, data_loader(name)) for name in self.names])
+        self.store.write_many([(name, frames[name][:100], None) for name in self.names])
+        # appends of interleaved symbols write new rows only, as new segments
+        for end in (200, 300):
+            self.store.append_many([
+                (name, frames[name][end - 100:end], '2017-01-01') for name in self.names
+            ])
+        self.assertEqual(self.store.garbage_rows(), 0)
+        self.assertEqual(len(self.store.info(self.names[0])['segments']), 3)
+        # single symbol append extends the last segment at the end of files
+        self.store.append_many([(self.names[1], frames[self.names[1]][300:350], None)])
+        self.assertEqual(len(self.store.info(self.names[1])['segments']), 3)
+        expected = dict(zip(self.names, [frames[self.names[0]][:300], frames[self.names[1]][:350]]))
+        for _ in range(2):
+            for name in self.names:
+                df = MarketStore(self.store_dir).load(name)
+                np.testing.assert_array_equal(df.values, expected[name][df.columns].values)
+                self.assertTrue((df.index == expected[name].index).all())
+                end = str(expected[name].index[-1].date())
+                self.assertEqual(self.store.info(name)['end'], end)
+            self.store.compact()
+            self.assertEqual(len(self.store.info(self.names[0])['segments']), 1)
+
+    def test_migrate_pickle_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            df = data_loader(self.names[0])
+            df[:5].to_pickle(
+                os.path.join(cache_dir, cached_filename(self.names[0], '2017-01-01')),
+                compression='gzip'
+            )
+            df.to_pickle(
+                os.path.join(cache_dir, cached_filename(self.names[0], '2017-02-01')),
+                compression='gzip'
+            )
+            self.assertEqual(migrate_pickle_cache(cache_dir, self.store), [self.names[0]])
+        finally:
+            shutil.rmtree(cache_dir)
+        # latest cache file is imported
+        stored = self.store.load(self.names[0])
+        np.testing.assert_array_equal(stored.values, df[stored.columns].values)
+        self.assertEqual(self.store.info(self.names[0])['updated'], '2017-02-01')
+
+
+class FakeBarSource(BarSource):
+    """bars of local frames, counts fetched rows"""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.fetched_rows = 0
+
+    def fetch(self, name, start, end):
+        df = self.frames[name]
+        df = df[(df.index >= start) & (df.index <= end)]
+        self.fetched_rows += df.shape[0]
+        return df
+
+
+class BarSourceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store = MarketStore(self.store_dir)
+        self.names = ['000333.SZ', '600016.SS']
+        self.frames = dict([(name, data_loader(name)) for name in self.names])
+        self.end = self.frames[self.names[0]].index[-1].date()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def assertStored(self, name, df):
+        stored = self.store.load(name)
+        np.testing.assert_allclose(stored.values, df[stored.columns].values)
+        self.assertTrue((stored.index == df.index).all())
+
+    def test_incremental_refresh(self):
+        old = self.frames[self.names[0]][:-20]
+        self.store.write(self.names[0], old, updated=old.index[-1].date())
+        source = FakeBarSource(self.frames)
+        stats = refresh_bars(self.store, source, self.names, end=self.end)
+        # only new bars and the last stored bar are fetched for stored symbol
+        self.assertEqual(
+            source.fetched_rows, 21 + self.frames[self.names[1]].shape[0]
+        )
+        self.assertEqual(stats['full_fetches'], 1)
+        for name in self.names:
+            self.assertStored(name, self.frames[name])
+            self.assertEqual(self.store.info(name)['updated'], str(self.end))
+        # stored history is not rewritten by refresh
+        self.assertEqual(self.store.garbage_rows(), 0)
+        # refreshed symbols are skipped until next day
+        stats = refresh_bars(self.store, source, self.names, end=self.end)
+        self.assertEqual(stats['symbols'], 0)
+
+    def test_adjusted_history(self):
+        name = self.names[0]
+        self.store.write(name, self.frames[name][:-5], updated='2017-01-01')
+        # dividend after last stored bar, source re-adjusts the whole history
+        adjusted = self.frames[name].copy()
+        adjusted['Adj Close'] *= 0.9
+        stats = refresh_bars(self.store, FakeBarSource({name: adjusted}), [name], end=self.end)
+        self.assertEqual(stats['rescaled'], 1)
+        self.assertStored(name, adjusted)
+        # raw history changed, fetch all again
+        changed = adjusted.copy()
+        changed['Close'] *= 1.1
+        stats = refresh_bars(
+            self.store, FakeBarSource({name: changed}), [name],
+            end=self.end + datetime.timedelta(days=1),
+        )
+        self.assertEqual(stats['full_fetches'], 1)
+        self.assertStored(name, changed)
+
+
+class FeatureCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.days = 30
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = FeatureCache(self.cache_dir)
+        # env data of earlier tests would be served from process cache
+        stock_data_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_all_features(self):
+        features = tuple(sorted(FEATURES.keys()))
+        data, pct_change = load_stock_data('000333.SZ', features=features)
+        self.assertEqual(data.shape, (pct_change.shape[0], len(features)))
+        self.assertTrue(data.flags.c_contiguous)
+        self.assertFalse(np.isnan(data).any())
+        self.assertNotEqual(feature_key(features), feature_key(BASE_FEATURES))
+
+    def test_env_on_cache(self):
+        features = BASE_FEATURES + ('log_return', 'volume_zscore_30')
+        env = FastTradingEnv(
+            name='000333.SZ', days=self.days, features=features, feature_cache=self.cache
+        )
+        cached_env = FastTradingEnv(
+            name='000333.SZ', days=self.days, features=features, feature_cache=self.cache
+        )
+        # second env reads memory-mapped arrays of first one
+        self.assertTrue(isinstance(cached_env.data, np.memmap))
+        np.testing.assert_array_equal(env.data, cached_env.data)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, feature_key(features)))), 2)
+        # base features are the same as before
+        base_env = FastTradingEnv(name='000333.SZ', days=self.days)
+        np.testing.assert_array_equal(env.data[:, :len(BASE_FEATURES)], base_env.data)
+        np.testing.assert_array_equal(env.pct_change, base_env.pct_change)
+        env.reset()
+        obs, reward, done, info = env.step(1)
+        self.assertEqual(obs.shape, (self.days, len(features)))
+
+    def test_refreshed_data(self):
+        name = '000333.SZ'
+        with mock.patch('envs.features.data_version', return_value='2017-01-03_100_2017-01-03'):
+            data, _ = self.cache.load(name)
+        with mock.patch('envs.features.load_stock_data') as load_stock_data, \
+                mock.patch('envs.features.data_version', return_value='2017-01-04_101_2017-01-04'):
+            load_stock_data.return_value = (data[1:], data[1:, 0])
+            refreshed, _ = self.cache.load(name)
+            # bars of stock are refreshed, features are computed again
+            self.assertEqual(load_stock_data.call_count, 1)
+            self.assertEqual(refreshed.shape[0], data.shape[0] - 1)
+            # stock data of processes is keyed by data version too
+            self.assertEqual(stock_data_cache.load(name)[0].shape[0], data.shape[0] - 1)
+        # files of old data version are removed
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.cache_dir, feature_key(BASE_FEATURES)))),
+            ['{n}.2017-01-04_101_2017-01-04.adj.{k}.npy'.format(n=name, k=k)
+             for k in ('data', 'pct_change')]
+        )
+
+    def test_data_version(self):
+        store_dir = tempfile.mkdtemp()
+        try:
+            name = '000333.SZ'
+            self.assertIsNone(data_version(name, store_dir=store_dir))
+            df = data_loader(name)
+            store = MarketStore.open(store_dir)
+            store.write(name, df[:-1], updated='2017-01-01')
+            version = data_version(name, store_dir=store_dir)
+            refresh_bars(
+                store, FakeBarSource({name: df}), [name], end=df.index[-1].date()
+            )
+            self.assertNotEqual(data_version(name, store_dir=store_dir), version)
+        finally:
+            shutil.rmtree(store_dir)
+
+
+
+class StockDataCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        stock_data_cache.clear()
+
+    def test_shared_env_data(self):
+        env = FastTradingEnv(name='000333.SZ', days=30)
+        other = FastTradingEnv(name='000333.SZ', days=30)
+        self.assertIs(other.data, env.data)
+        self.assertFalse(env.data.flags.writeable)
+        self.assertEqual((stock_data_cache.misses, stock_data_cache.hits), (1, 1))
+        # adjusted close and features are part of key
+        FastTradingEnv(name='000333.SZ', days=30, use_adjust_close=False)
+        FastTradingEnv(name='000333.SZ', days=30, features=BASE_FEATURES + ('log_return',))
+        self.assertEqual(stock_data_cache.misses, 3)
+        total = timeit.timeit(lambda: FastTradingEnv(name='000333.SZ', days=30), number=100)
+        print 'avg: {t} seconds per cached env'.format(t=total/100)
+
+    def test_lru(self):
+        cache = StockDataCache(max_size=2)
+        names = ['000333.SZ', '600016.SS', '600000.SS']
+        for name in names + names[-1:]:
+            cache.load(name)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.misses, cache.hits), (3, 1))
+        # least recently used one is evicted
+        cache.load(names[1])
+        cache.load(names[0])
+        self.assertEqual((cache.misses, cache.hits), (4, 2))
+
+    def test_stock_not_in_store(self):
+        cache = StockDataCache()
+        data = np.ones((10, len(BASE_FEATURES)))
+        # bars are stored by first load, so data version changes from None
+        with mock.patch('envs.features.load_stock_data') as load_stock_data, \
+                mock.patch('envs.features.data_version', side_effect=[None, 'v1', 'v1']):
+            load_stock_data.return_value = (data, data[:, 0])
+            item = cache.load('000333.SZ')
+            self.assertIs(cache.load('000333.SZ'), item)
+        self.assertEqual(load_stock_data.call_count, 1)
+        self.assertEqual((len(cache), cache.misses, cache.hits), (1, 1, 1))
+
+
 if __name__ == '__main__':
     unittest.main()
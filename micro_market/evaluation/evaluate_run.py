@@ -12,6 +12,12 @@ def eval_run_func(params):
     input_shape = params['input_shape']
     rounds = params['rounds']
     valid_stocks = params['valid_stocks']
-    _evaluator = Evaluator(model_dir=model_dir, input_shape=input_shape)
+    panel_dir = params.get('panel_dir')
+    features = params.get('features')
+    episode_length = params.get('episode_length')
+    _evaluator = Evaluator(
+        model_dir=model_dir, input_shape=input_shape, panel_dir=panel_dir, features=features,
+        episode_length=episode_length,
+    )
     BAR, EAR = _evaluator.evaluate(basic_model, evaluate_model, valid_stocks, rounds)
     return BAR, EAR
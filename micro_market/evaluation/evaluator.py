@@ -5,34 +5,54 @@ import logging
 import numpy as np
 import pandas as pd
 
+from common import settings
 from envs.fast_trading_env import FastTradingEnv
+from envs.market_panel import MarketPanel
+from envs.features import FeatureCache
+from envs.action_sequences import sequence_rewards
 
 logger = logging.getLogger(__name__)
 
 
 class Evaluator(object):
 
-    def __init__(self, model_dir, input_shape):
+    def __init__(self, model_dir, input_shape, panel_dir=None, features=None, episode_length=None):
+        """
+            Args:
+                input_shape (tuple): model input (obs window, features)
+                episode_length (int): days of episode, default obs window
+        """
         self._model_dir = model_dir
         self._input_shape = input_shape
+        self._episode_length = episode_length or input_shape[0]
+        self._panel = MarketPanel.open(panel_dir)
+        # features of stocks not in panel are computed once and read from disk cache
+        self._feature_cache = FeatureCache(settings.FEATURE_CACHE_DIR)
+        self._features = features
 
     def evaluate_on_env(self, model, env):
+        """
+            evaluate model on a whole episode of env from step 0,
+            obs do not depend on actions, so all steps are predicted in one batch
+            and actions are replayed in closed form without stepping env
+        """
+        idx, step = env.state_ref()
+        assert(step == 0)
+        all_obs = [env.observations(data_step) for data_step in range(env.days + 1)]
+        ps, vs = model.predict_batch(all_obs[:-1])
+        actions = np.argmax(ps, axis=1)
+        _, navs, _ = env.evaluate_sequences(actions[None, :], idx=idx)
+        rewards = sequence_rewards(actions[None, :], navs, env.trading_cost_pct_change)[0]
         eval_history = []
-        done = False
-        last_obs = env.observations()
-        while not done:
-            p, v = model.predict(last_obs)
-            action = np.argmax(p)
-            obs, reward, done, _ = env.step(action)
+        for data_step in range(env.days):
             eval_history.append({
-                'action_values': p,
-                'predict_reward': v,
-                'real_reward': reward,
-                'pre_obs': last_obs,
-                'post_obs': obs,
-                'action': action,
+                'action_values': ps[data_step],
+                'predict_reward': vs[data_step],
+                'real_reward': rewards[data_step],
+                'pre_obs': all_obs[data_step],
+                'post_obs': all_obs[data_step + 1],
+                'action': actions[data_step],
             })
-            last_obs = obs
         return eval_history
 
     def evaluate(self, basic_model, evaluate_model, valid_stocks, rounds):
@@ -59,15 +79,15 @@ class Evaluator(object):
             stock_name = np.random.choice(valid_stocks, 1)[0]
             try:
                 env = FastTradingEnv(
-                    name=stock_name, days=self._input_shape[0], use_adjust_close=False
+                    name=stock_name, days=self._episode_length, use_adjust_close=False,
+                    panel=self._panel, features=self._features, window=self._input_shape[0],
+                    feature_cache=self._feature_cache,
                 )
             except Exception as e:
                 logger.exception('env init error, {e}'.format(e=e))
                 continue
-            env_snapshot = env.snapshot()
             basic_evals = self.evaluate_on_env(bm, env)
             basic_avg_reward += basic_evals[-1]['real_reward']
-            env.recover(env_snapshot)
             evaluate_evals = self.evaluate_on_env(em, env)
             evaluate_avg_reward += evaluate_evals[-1]['real_reward']
             _count += 1
@@ -0,0 +1,28 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import logging
+
+from common import settings
+from common.dataset import StockDataSet
+from envs.features import FeatureCache
+from envs.market_panel import build_panel
+
+logger = logging.getLogger(__name__)
+
+
+def build():
+    """build market panel of all stocks once, sim and validation workers attach to it"""
+    ds = StockDataSet()
+    stock_codes = ds.stock_list(min_days=settings.EPISODE_LENGTH)
+    symbols = build_panel(
+        stock_codes, settings.MARKET_PANEL_DIR, use_adjust_close=False,
+        features=settings.FEATURES, feature_cache=FeatureCache(settings.FEATURE_CACHE_DIR),
+    )
+    logger.info('[PANEL] {n}/{t} stocks in panel'.format(n=len(symbols), t=len(stock_codes)))
+
+
+if __name__ == '__main__':
+    assert(logger)
+    logging.basicConfig(filename='build_panel.log', level=logging.INFO)
+    build()
@@ -1,49 +1,146 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import os
+import json
+import time
+import socket
 import logging
+from datetime import datetime
 from concurrent import futures
+import requests
 import tushare as ts
 
-from envs.data_loader import data_loader
+from common.utils import RateLimiter, jittered_backoff
+from envs.data_loader import STORE_DIR
+from envs.market_store import MarketStore
+from envs.bar_source import DEFAULT_START, TransientSourceError, YahooBarSource, pooled_session
 
 logger = logging.getLogger(__name__)
 
 
-def _get_stock_data(code):
-    # call env for loading data
-    data_loader(code)
-    return True
+def is_transient_error(e):
+    """
+        connection errors, timeouts, 429 and 5xx responses and TransientSourceError
+        of sources may succeed on retry
+    """
+    if isinstance(e, (
+        requests.ConnectionError, requests.Timeout, socket.error, TransientSourceError
+    )):
+        return True
+    response = getattr(e, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
 
 
 class DataCollector(object):
-    def __init__(self, timeout=60):
-        self._timeout = timeout
+    """
+        download bars of many symbols into MarketStore with one long-lived thread pool,
+        HTTP connections are pooled and bounded by `workers`, requests of the source are
+        rate limited, transient download errors are retried with jittered exponential backoff.
+        symbols already in store are skipped, so an interrupted run resumes where it stopped,
+        done and failed symbols of the store are recorded in `progress_file`
+    """
 
-    def get_stock_codes(self, batch_size=1):
+    def __init__(
+        self, source=None, store=None, workers=8, rate_limit=5.0, max_retries=5,
+        backoff=1.0, max_backoff=60.0, progress_file='data_collector.progress.json',
+        write_batch_size=50, start=DEFAULT_START,
+    ):
+        """
+            Args:
+                source (BarSource): default YahooBarSource with pooled session
+                rate_limit (float): max requests per second to source
+        """
+        self._source = source or YahooBarSource(session=pooled_session(workers))
+        self._store = store or MarketStore.open(STORE_DIR)
+        self._workers = workers
+        self._rate_limiter = RateLimiter(rate_limit)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._progress_file = progress_file
+        self._write_batch_size = write_batch_size
+        self._start = start
+
+    def get_stock_codes(self):
         stock_basics = ts.get_stock_basics()
-        stock_codes = [
+        return [
             r[0] + ('.SS' if int(r[0][0]) >= 5 else '.SZ') for r in stock_basics.iterrows()
         ]
-        l = len(stock_codes)
-        for ndx in range(0, l, batch_size):
-            yield stock_codes[ndx:min(ndx + batch_size, l)]
-
-    def run(self, batch_size=10):
-        for codes in self.get_stock_codes(batch_size=batch_size):
-            logger.info('collecting stocks: {codes}'.format(codes=codes))
-            with futures.ProcessPoolExecutor(max_workers=batch_size) as executor:
-                _tasks = [executor.submit(_get_stock_data, code) for code in codes]
-                try:
-                    for future in futures.as_completed(_tasks, timeout=self._timeout):
-                        exception = future.exception()
-                        if exception:
-                            logger.error('collect error: {e}'.format(e=exception))
-                            continue
-                        logger.info('collect finished')
-                except futures.TimeoutError:
-                    logger.error('some futures timeout')
-            logger.info('finished collect stocks: {codes}'.format(codes=codes))
+
+    def _load_progress(self):
+        if not self._progress_file or not os.path.exists(self._progress_file):
+            return {'done': [], 'failed': {}}
+        with open(self._progress_file) as f:
+            return json.load(f)
+
+    def _save_progress(self, progress):
+        if not self._progress_file:
+            return
+        tmp_path = self._progress_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(progress, f)
+        os.rename(tmp_path, self._progress_file)
+
+    def _fetch(self, name, end):
+        for attempt in range(self._max_retries + 1):
+            self._rate_limiter.acquire()
+            try:
+                return self._source.fetch(name, self._start, end)
+            except Exception as e:
+                if attempt == self._max_retries or not is_transient_error(e):
+                    raise
+                delay = jittered_backoff(attempt, base=self._backoff, cap=self._max_backoff)
+                logger.warning('fetch {name} error, retry in {d:.2f}s: {e}'.format(
+                    name=name, d=delay, e=e
+                ))
+                time.sleep(delay)
+
+    def run(self, codes=None):
+        """
+            collect symbols `codes` (default all stocks), symbols already in store are
+            skipped, new bars of them are fetched by refresh_bars
+            Returns:
+                dict: progress, done symbols and errors of failed symbols
+        """
+        codes = codes or self.get_stock_codes()
+        progress = self._load_progress()
+        # progress of another store is not trusted, stored symbols are done
+        progress['done'] = [code for code in progress['done'] if self._store.has(code)]
+        pending = [code for code in codes if not self._store.has(code)]
+        logger.info('collecting {n} stocks, {d} done before'.format(
+            n=len(pending), d=len(progress['done'])
+        ))
+        end = datetime.now()
+        items = []
+
+        def flush():
+            # results are streamed into store in batches as they arrive
+            if items:
+                self._store.write_many(items)
+            progress['done'].extend([name for name, _, _ in items])
+            self._save_progress(progress)
+            del items[:]
+
+        with futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            tasks = dict([(executor.submit(self._fetch, code, end), code) for code in pending])
+            for future in futures.as_completed(tasks):
+                code = tasks[future]
+                exception = future.exception()
+                if exception:
+                    logger.error('collect {code} error: {e}'.format(code=code, e=exception))
+                    progress['failed'][code] = str(exception)
+                    continue
+                progress['failed'].pop(code, None)
+                items.append((code, future.result(), end.date()))
+                if len(items) >= self._write_batch_size:
+                    flush()
+        flush()
+        logger.info('finished collecting, {d} done, {f} failed'.format(
+            d=len(progress['done']), f=len(progress['failed'])
+        ))
+        return progress
 
 
 if __name__ == '__main__':
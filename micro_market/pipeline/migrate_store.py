@@ -0,0 +1,23 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import sys
+import logging
+
+from envs.data_loader import STORE_DIR
+from envs.market_store import MarketStore, migrate_pickle_cache
+
+logger = logging.getLogger(__name__)
+
+
+def migrate(cache_dir='./tmp_data/', store_dir=STORE_DIR):
+    """import old `*_data.pkl.gz` cache files into local market store"""
+    store = MarketStore.open(store_dir)
+    symbols = migrate_pickle_cache(cache_dir, store)
+    logger.info('[MIGRATE] {n} symbols imported into [{d}]'.format(n=len(symbols), d=store_dir))
+
+
+if __name__ == '__main__':
+    assert(logger)
+    logging.basicConfig(filename='migrate_store.log', level=logging.INFO)
+    migrate(*sys.argv[1:])
@@ -18,10 +18,16 @@ class PolicyValidator(object):
 
     CURRENT_MODEL_FILE = settings.CURRENT_MODEL_FILE
 
-    def __init__(self, model_dir, input_shape, debug=False):
+    def __init__(
+        self, model_dir, input_shape, panel_dir=None, features=None, episode_length=None,
+        debug=False,
+    ):
         assert(model_dir and len(input_shape) == 2)
         self._input_shape = input_shape
+        self._episode_length = episode_length
         self._model_dir = model_dir
+        self._panel_dir = panel_dir
+        self._features = features
         self._debug = debug
         self._validated_models = set()
 
@@ -42,8 +48,11 @@ class PolicyValidator(object):
                     'basic_model': basic_model,
                     'evaluate_model': evaluate_model,
                     'input_shape': self._input_shape,
+                    'episode_length': self._episode_length,
                     'rounds': rounds,
                     'valid_stocks': valid_stocks,
+                    'panel_dir': self._panel_dir,
+                    'features': self._features,
                 }
             )
             res = f.result()
@@ -0,0 +1,23 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import logging
+
+from envs.data_loader import STORE_DIR
+from envs.market_store import MarketStore
+from envs.bar_source import YahooBarSource, refresh_bars
+
+logger = logging.getLogger(__name__)
+
+
+def refresh(store_dir=STORE_DIR):
+    """nightly update, fetch new bars of all stored symbols only"""
+    store = MarketStore.open(store_dir)
+    stats = refresh_bars(store, YahooBarSource(), store.symbols)
+    logger.info('[REFRESH] {s}'.format(s=stats))
+
+
+if __name__ == '__main__':
+    assert(logger)
+    logging.basicConfig(filename='refresh_data.log', level=logging.INFO)
+    refresh()
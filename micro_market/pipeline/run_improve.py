@@ -15,7 +15,7 @@ def improvement(base_model_name):
     policy_iter = PolicyIterator(
         model_dir=settings.MODEL_DATA_DIR,
         data_dir=settings.SIM_DATA_DIR,
-        input_shape=(settings.EPISODE_LENGTH, settings.FEATURE_NUM),
+        input_shape=(settings.OBS_WINDOW, settings.FEATURE_NUM),
         data_buffer_size=settings.DATA_BUFFER_SIZE,
     )
     if not os.path.exists(settings.CURRENT_MODEL_FILE):
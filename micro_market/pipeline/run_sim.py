@@ -14,7 +14,7 @@ logger = logging.getLogger(__name__)
 
 
 def evaluation(base_model_name):
-    input_shape = (settings.EPISODE_LENGTH, settings.FEATURE_NUM)
+    input_shape = (settings.OBS_WINDOW, settings.FEATURE_NUM)
     ds = StockDataSet()
     stock_codes = ds.stock_list(min_days=settings.EPISODE_LENGTH)
 
@@ -37,11 +37,22 @@ def evaluation(base_model_name):
             train_stocks=stock_codes[:ds.TRAIN_SIZE],
             model_name=base_model_name,
             input_shape=input_shape,
+            episode_length=settings.EPISODE_LENGTH,
             explore_rate=1e-01,
             model_dir=settings.MODEL_DATA_DIR,
             data_dir=settings.SIM_DATA_DIR,
             sim_count=settings.SIM_ROUNDS,
             rounds_per_step=settings.SIM_ROUNDS_PER_STEP,
+            leaf_batch_size=settings.SIM_LEAF_BATCH_SIZE,
+            max_tree_nodes=settings.SIM_MAX_TREE_NODES,
+            endgame_levels=settings.SIM_ENDGAME_LEVELS,
+            tree_dir=settings.SIM_TREE_DIR,
+            early_stop=settings.SIM_EARLY_STOP,
+            precompute_evals=settings.SIM_PRECOMPUTE_EVALS,
+            root_search=settings.SIM_ROOT_SEARCH,
+            search_horizon=settings.SIM_SEARCH_HORIZON,
+            panel_dir=settings.MARKET_PANEL_DIR,
+            features=settings.FEATURES,
         )
         sim_gen.run(sim_batch_size=settings.SIM_BATCH_SIZE, worker_num=settings.CPU_CORES)
         logger.info('finished generation: {g}\ncurrent model: {mn}'.format(
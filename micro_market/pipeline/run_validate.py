@@ -22,7 +22,10 @@ def validation():
     stock_codes = ds.stock_list(min_days=settings.EPISODE_LENGTH)
     policy_validator = PolicyValidator(
         model_dir=settings.MODEL_DATA_DIR,
-        input_shape=(settings.EPISODE_LENGTH, settings.FEATURE_NUM),
+        input_shape=(settings.OBS_WINDOW, settings.FEATURE_NUM),
+        episode_length=settings.EPISODE_LENGTH,
+        panel_dir=settings.MARKET_PANEL_DIR,
+        features=settings.FEATURES,
     )
     base_model_name = None
     while True:
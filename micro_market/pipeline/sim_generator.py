@@ -20,16 +20,35 @@ class SimGenerator(object):
     def __init__(
         self, train_stocks, model_name, explore_rate, input_shape, model_dir,
         data_dir, debug=False, sim_count=2500, rounds_per_step=1000, worker_timeout=300,
+        leaf_batch_size=1, max_tree_nodes=None, endgame_levels=0, tree_dir=None,
+        early_stop=False, precompute_evals=False, root_search='puct', panel_dir=None,
+        features=None, episode_length=None, search_horizon=None,
     ):
+        """
+            Args:
+                input_shape (tuple): model input (obs window, features)
+                episode_length (int): days of episode, default obs window
+        """
         assert(len(input_shape) == 2)
         self._model_name = model_name
         self._model_dir = model_dir
         self._input_shape = input_shape
+        self._episode_length = episode_length or input_shape[0]
         self._explore_rate = explore_rate
         self._train_stocks = train_stocks
         self._data_dir = data_dir
         self._sim_count = sim_count
         self._rounds_per_step = rounds_per_step
+        self._leaf_batch_size = leaf_batch_size
+        self._max_tree_nodes = max_tree_nodes
+        self._endgame_levels = endgame_levels
+        self._tree_dir = tree_dir
+        self._early_stop = early_stop
+        self._precompute_evals = precompute_evals
+        self._root_search = root_search
+        self._search_horizon = search_horizon
+        self._panel_dir = panel_dir
+        self._features = features
         self._worker_timeout = worker_timeout
         self._debug = debug
 
@@ -40,7 +59,7 @@ class SimGenerator(object):
         return os.path.join(data_dir, file_name)
 
     def run(self, sim_batch_size=100, worker_num=4):
-        episode_length = self._input_shape[0]
+        episode_length = self._episode_length
         batch_data_length = sim_batch_size * episode_length
         progress_bar = tqdm(total=self._sim_count)
         for idx in range(0, self._sim_count, sim_batch_size):
@@ -50,7 +69,18 @@ class SimGenerator(object):
                     _tasks = [executor.submit(sim_run_func, {
                         'stock_name': random.choice(self._train_stocks),
                         'input_shape': self._input_shape,
+                        'episode_length': self._episode_length,
                         'rounds_per_step': self._rounds_per_step,
+                        'leaf_batch_size': self._leaf_batch_size,
+                        'max_tree_nodes': self._max_tree_nodes,
+                        'endgame_levels': self._endgame_levels,
+                        'tree_dir': self._tree_dir,
+                        'early_stop': self._early_stop,
+                        'precompute_evals': self._precompute_evals,
+                        'root_search': self._root_search,
+                        'search_horizon': self._search_horizon,
+                        'panel_dir': self._panel_dir,
+                        'features': self._features,
                         'model_name': self._model_name,
                         'model_dir': self._model_dir,
                         'sim_explore_rate': self._explore_rate,
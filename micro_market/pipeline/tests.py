@@ -0,0 +1,140 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import mock
+import numpy as np
+import requests
+
+from envs.data_loader import data_loader
+from envs.market_store import MarketStore
+from envs.bar_source import HttpBarSource, YahooBarSource, pooled_session
+from pipeline.data_collector import DataCollector, is_transient_error
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class BarServer(object):
+    """local HTTP stand-in of a bar source, fails first request of every symbol"""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = urlparse.urlparse(self.path).path.strip('/')
+                server.requests.append(name)
+                if name not in server.frames:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if server.requests.count(name) == 1:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = server.frames[name].to_csv()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url_template = 'http://127.0.0.1:{port}/{{name}}?start={{start}}&end={{end}}'.format(
+            port=self._httpd.server_address[1]
+        )
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class DataCollectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.names = ['000333.SZ', '600016.SS', '600000.SS']
+        self.frames = dict([(name, data_loader(name)) for name in self.names])
+        self.server = BarServer(self.frames)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _collector(self, store):
+        source = HttpBarSource(self.server.url_template, session=pooled_session(4))
+        return DataCollector(
+            source=source, store=store, workers=4, rate_limit=100.0, max_retries=2,
+            backoff=0.01, progress_file=os.path.join(self.tmp_dir, 'progress.json'),
+            write_batch_size=2,
+        )
+
+    def test_collect(self):
+        store = MarketStore(os.path.join(self.tmp_dir, 'store'))
+        progress = self._collector(store).run(codes=self.names + ['missing.SZ'])
+        self.assertEqual(sorted(progress['done']), sorted(self.names))
+        # not found symbol fails without retries
+        self.assertEqual(list(progress['failed'].keys()), ['missing.SZ'])
+        self.assertEqual(self.server.requests.count('missing.SZ'), 1)
+        for name in self.names:
+            # failed first request is retried
+            self.assertEqual(self.server.requests.count(name), 2)
+            df = store.load(name)
+            np.testing.assert_allclose(df.values, self.frames[name][df.columns].values)
+        # resume against the same store, stored symbols are not downloaded again
+        del self.server.requests[:]
+        progress = self._collector(store).run(codes=self.names)
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(sorted(progress['done']), sorted(self.names))
+        # progress file of another store does not skip symbols
+        other = MarketStore(os.path.join(self.tmp_dir, 'other'))
+        progress = self._collector(other).run(codes=self.names)
+        self.assertEqual(sorted(set(self.server.requests)), sorted(self.names))
+        self.assertEqual(sorted(other.symbols), sorted(self.names))
+        self.assertEqual(sorted(progress['done']), sorted(self.names))
+
+    def test_transient_error(self):
+        def http_error(status_code):
+            response = requests.Response()
+            response.status_code = status_code
+            return requests.HTTPError(response=response)
+        for e in (requests.ConnectionError(), requests.Timeout(), http_error(429),
+                  http_error(503)):
+            self.assertTrue(is_transient_error(e))
+        for e in (http_error(404), http_error(400), ValueError()):
+            self.assertFalse(is_transient_error(e))
+
+    def test_yahoo_source_retry(self):
+        from pandas_datareader._utils import RemoteDataError
+        name = self.names[0]
+        store = MarketStore(os.path.join(self.tmp_dir, 'store'))
+        collector = DataCollector(
+            source=YahooBarSource(), store=store, workers=1, rate_limit=100.0, max_retries=2,
+            backoff=0.01, progress_file=os.path.join(self.tmp_dir, 'progress.json'),
+        )
+        # pandas-datareader raises RemoteDataError for 429 and 5xx responses
+        with mock.patch('pandas_datareader.data.DataReader') as data_reader:
+            data_reader.side_effect = [RemoteDataError('Unable to read URL'), self.frames[name]]
+            progress = collector.run(codes=[name])
+        self.assertEqual(data_reader.call_count, 2)
+        self.assertEqual(progress['done'], [name])
+        self.assertEqual(progress['failed'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
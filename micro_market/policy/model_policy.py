@@ -25,3 +25,8 @@ class ModelTradingPolicy(BasePolicy):
         # evaluate by using model
         p, v = self._model.predict(state, debug=self._debug)
         return p, v
+
+    def evaluate_batch(self, states):
+        # evaluate all states in one model call
+        ps, vs = self._model.predict_batch(states, debug=self._debug)
+        return ps, vs
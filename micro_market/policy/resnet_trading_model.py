@@ -118,3 +118,10 @@ class ResnetTradingModel(object):
         batch_x = np.expand_dims(x, axis=0)
         outputs = self._model.predict(self._preprocess(batch_x), batch_size=1, verbose=debug)
         return np.squeeze(outputs[0], axis=0), np.squeeze(outputs[1], axis=0)[0]
+
+    def predict_batch(self, xs, debug=False):
+        batch_x = np.array(xs)
+        outputs = self._model.predict(
+            self._preprocess(batch_x), batch_size=batch_x.shape[0], verbose=debug
+        )
+        return outputs[0], outputs[1][:, 0]
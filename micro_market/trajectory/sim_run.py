@@ -3,7 +3,10 @@ from __future__ import unicode_literals
 
 import logging
 
+from common import settings
 from envs.fast_trading_env import FastTradingEnv
+from envs.market_panel import MarketPanel
+from envs.features import FeatureCache
 
 logger = logging.getLogger(__name__)
 
@@ -16,14 +19,29 @@ def sim_run_func(params):
     # get input parameters
     stock_name = params['stock_name']
     input_shape = params['input_shape']
+    episode_length = params.get('episode_length') or input_shape[0]
     rounds_per_step = params['rounds_per_step']
     model_name = params['model_name']
     model_dir = params['model_dir']
     sim_explore_rate = params['sim_explore_rate']
+    leaf_batch_size = params.get('leaf_batch_size', 1)
+    max_tree_nodes = params.get('max_tree_nodes')
+    endgame_levels = params.get('endgame_levels', 0)
+    tree_dir = params.get('tree_dir')
+    early_stop = params.get('early_stop', False)
+    precompute_evals = params.get('precompute_evals', False)
+    root_search = params.get('root_search', 'puct')
+    search_horizon = params.get('search_horizon')
+    panel_dir = params.get('panel_dir')
+    features = params.get('features')
     specific_model_name = params.get('specific_model_name')
     debug = params.get('debug', False)
-    # create env
-    _env = FastTradingEnv(name=stock_name, days=input_shape[0], use_adjust_close=False)
+    # create env, features of stock not in panel are read from disk cache
+    _env = FastTradingEnv(
+        name=stock_name, days=episode_length, use_adjust_close=False,
+        panel=MarketPanel.open(panel_dir), features=features, window=input_shape[0],
+        feature_cache=FeatureCache(settings.FEATURE_CACHE_DIR),
+    )
     _env.reset()
     logger.debug('created env[{name}:{shape}]'.format(name=stock_name, shape=input_shape))
     # load model
@@ -39,7 +57,11 @@ def sim_run_func(params):
     logger.debug('built policy with model[{name}]'.format(name=model_name))
     # start sim trajectory
     _sim = SimTrajectory(
-        env=_env, model_policy=_policy, explore_rate=sim_explore_rate, debug=debug
+        env=_env, model_policy=_policy, explore_rate=sim_explore_rate,
+        leaf_batch_size=leaf_batch_size, max_tree_nodes=max_tree_nodes,
+        endgame_levels=endgame_levels, tree_dir=tree_dir, early_stop=early_stop,
+        precompute_evals=precompute_evals, root_search=root_search,
+        search_horizon=search_horizon, debug=debug
     )
     logger.debug('start simulate trajectory, rounds_per_step({r})'.format(r=rounds_per_step))
     _sim.sim_run(rounds_per_step=rounds_per_step)
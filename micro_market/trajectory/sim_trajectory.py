@@ -1,43 +1,145 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import os
+import errno
+import logging
 # from tqdm import tqdm
 
 from envs.fast_trading_env import FastTradingEnv
 from MCTS.mcts import MCTSBuilder
+from MCTS.search_context import SearchContext
+from MCTS.tree_io import tree_file_name, save_tree, load_tree, read_header
 from sim_policy import SimPolicy
 
+logger = logging.getLogger(__name__)
+
 
 class SimTrajectory(object):
-    def __init__(self, env, model_policy, explore_rate=1e-01, debug=False):
+    def __init__(
+        self, env, model_policy, explore_rate=1e-01, leaf_batch_size=1, max_tree_nodes=None,
+        endgame_levels=0, tree_dir=None, early_stop=False, precompute_evals=False,
+        root_search='puct', search_horizon=None, debug=False
+    ):
+        """
+            Args:
+                early_stop (bool): stop search of a step once its best action is fixed
+                precompute_evals (bool): evaluate all steps of episode in one model call
+                root_search (string): root search algorithm of MCTSBuilder, 'puct' or 'gumbel'
+                search_horizon (int): max simulation depth of each step search, see SearchContext
+                tree_dir (string): cache dir of first step search trees, trees of the same
+                    (stock, idx) and env/search settings are loaded as warm start
+        """
         assert(env and model_policy)
         self._debug = debug
+        self._leaf_batch_size = leaf_batch_size
+        self._early_stop = early_stop
+        self._search_config = {
+            'max_nodes': max_tree_nodes,
+            'endgame_levels': endgame_levels,
+            'precompute_evals': precompute_evals,
+            'horizon': search_horizon,
+        }
+        self._root_search = root_search
+        if root_search == 'gumbel':
+            # no dirichlet noise for gumbel root search, also for warm start trees
+            self._search_config['episolon'] = 0.0
+        self._tree_dir = tree_dir
         self._main_env = env
         self._explore_rate = explore_rate
         self._exploit_policy = model_policy
         self._sim_policy = SimPolicy(action_options=self._main_env.action_options())
 
         # change every step of trajectory
+        self._context = None  # search context shared by search trees of all steps
         self._sim_history = []
+        self._search_stats = []  # search stats summary of every step
         self._tmp_env = FastTradingEnv(
-            name=self._main_env.name, days=self._main_env.days, use_adjust_close=False
+            name=self._main_env.name, days=self._main_env.days, use_adjust_close=False,
+            panel=self._main_env.panel, features=self._main_env.features,
+            feature_cache=self._main_env.feature_cache, window=self._main_env.window,
         )
 
     @property
     def history(self):
         return self._sim_history
 
-    def _state_evaluation(self, init_node=None, rounds_per_step=100):
-        # TODO: optimize when nearly end of episode, change from mcts to traverse search
-        # do MCTS
-        mcts_block = MCTSBuilder(self._tmp_env, init_node=init_node, debug=self._debug)
+    @property
+    def search_stats(self):
+        return self._search_stats
+
+    def _state_evaluation(
+        self, init_node=None, context=None, rounds_per_step=100, time_budget_ms=None
+    ):
+        # do MCTS, last `endgame_levels` levels are solved exactly
+        mcts_block = MCTSBuilder(
+            self._tmp_env, init_node=init_node, context=context, debug=self._debug,
+            root_search=self._root_search, **self._search_config
+        )
+        self._context = mcts_block.context
         root_node = mcts_block.run_batch(
             policy=self._exploit_policy,
             env_snapshot=self._main_env.snapshot(),
-            batch_size=rounds_per_step
+            batch_size=rounds_per_step,
+            leaf_batch_size=self._leaf_batch_size,
+            early_stop=self._early_stop,
+            time_budget_ms=time_budget_ms,
         )
+        # stats of this step only, context is shared with the next step tree
+        stats_summary = mcts_block.stats_summary()
+        mcts_block.stats.reset()
+        self._search_stats.append(stats_summary)
+        logger.debug('search stats: {s}'.format(s=stats_summary))
         return root_node
 
+    def _init_tree_path(self):
+        if not self._tree_dir:
+            return None
+        snapshot = self._main_env.snapshot()
+        return os.path.join(
+            self._tree_dir, tree_file_name(self._main_env.name, snapshot['idx'], snapshot['step'])
+        )
+
+    def _tree_meta(self):
+        snapshot = self._main_env.snapshot()
+        # trees searched with other episode, obs or search settings are not reused
+        return dict(
+            self._search_config,
+            root_search=self._root_search,
+            name=self._main_env.name,
+            idx=int(snapshot['idx']),
+            step=snapshot['step'],
+            days=self._main_env.days,
+            window=self._main_env.window,
+            features=list(self._main_env.features),
+        )
+
+    def _load_init_tree(self):
+        tree_path = self._init_tree_path()
+        if not tree_path or not os.path.exists(tree_path):
+            return None
+        try:
+            meta = read_header(tree_path)['meta']
+        except ValueError as e:
+            logger.warning('skip tree [{p}]: {e}'.format(p=tree_path, e=e))
+            return None
+        if meta != self._tree_meta():
+            logger.debug('skip tree [{p}] of other settings'.format(p=tree_path))
+            return None
+        context = SearchContext(env=self._tmp_env, **self._search_config)
+        logger.debug('warm start from tree [{p}]'.format(p=tree_path))
+        return load_tree(tree_path, context)
+
+    def _save_init_tree(self, root_node):
+        tree_path = self._init_tree_path()
+        try:
+            os.makedirs(self._tree_dir)
+        except OSError as e:
+            # created by another worker
+            if e.errno != errno.EEXIST:
+                raise
+        save_tree(root_node, tree_path, meta=self._tree_meta())
+
     def _sim_step(self, q_table):
         # get action with q_table
         action = self._sim_policy.get_action(q_table)
@@ -53,14 +155,24 @@ class SimTrajectory(object):
         self._last_obs = obs
         return action, done
 
-    def sim_run(self, rounds_per_step=100):
+    def sim_run(self, rounds_per_step=100, time_budget_ms=None):
+        """
+            Args:
+                time_budget_ms (float): search time limit of each step,
+                    `rounds_per_step` is max simulations then
+        """
         done = False
-        init_node = None
+        init_node = self._load_init_tree()
         self._last_obs = self._main_env.observations()
         # progress_bar = tqdm(total=self._main_env.days)
         while not done:
+            # context is kept when last step tree was released, e.g. root solved by endgame
             result_node = self._state_evaluation(
-                init_node=init_node, rounds_per_step=rounds_per_step)
+                init_node=init_node, context=self._context, rounds_per_step=rounds_per_step,
+                time_budget_ms=time_budget_ms)
+            if self._tree_dir and not self._sim_history:
+                # cache first step tree before sub trees are released
+                self._save_init_tree(result_node)
             if self._debug:
                 result_node.show_graph()
                 print result_node.q_table
@@ -1,8 +1,12 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import os
+import shutil
+import tempfile
 import unittest
 from envs.fast_trading_env import FastTradingEnv
+from MCTS.trading_policy import HoldTradingPolicy
 
 from policy.resnet_trading_model import ResnetTradingModel
 from policy.model_policy import ModelTradingPolicy
@@ -41,6 +45,28 @@ class SimTrajectoryTestCase(unittest.TestCase):
         print t.history
         self.assertEqual(len(t.history), self.days)
 
+    def test_warm_start_settings(self):
+        tree_dir = tempfile.mkdtemp()
+        try:
+            snapshot = self.env.snapshot()
+            policy = HoldTradingPolicy(action_options=self.env.action_options())
+            SimTrajectory(
+                env=self.env, model_policy=policy, tree_dir=tree_dir, search_horizon=5
+            ).sim_run(rounds_per_step=4)
+            self.assertEqual(len(os.listdir(tree_dir)), 1)
+            self.env.recover(snapshot)
+            same = SimTrajectory(
+                env=self.env, model_policy=policy, tree_dir=tree_dir, search_horizon=5
+            )
+            self.assertIsNotNone(same._load_init_tree())
+            # tree searched with another horizon is not loaded
+            other = SimTrajectory(
+                env=self.env, model_policy=policy, tree_dir=tree_dir, search_horizon=10
+            )
+            self.assertIsNone(other._load_init_tree())
+        finally:
+            shutil.rmtree(tree_dir)
+
 
 if __name__ == '__main__':
     unittest.main()